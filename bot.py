@@ -1,13 +1,22 @@
 import os
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import time
-import json
+import orjson
 from datetime import datetime
 import logging
-import traceback
 import csv
-from http.server import HTTPServer, BaseHTTPRequestHandler
+import sqlite3
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor, Future
+from collections import OrderedDict, deque
+import io
+import tempfile
+import secrets
+import signal
 
 # ==================== CONFIGURATION ====================
 print("🚀 Starting FreshMart Grocery Delivery Bot on Railway...")
@@ -15,8 +24,17 @@ print("🚀 Starting FreshMart Grocery Delivery Bot on Railway...")
 # Get credentials from environment (Railway Environment Variables)
 TELEGRAM_TOKEN = os.environ.get('TELEGRAM_TOKEN')
 ADMIN_CHAT_ID = os.environ.get('ADMIN_CHAT_ID')
+TELEGRAM_API_URL = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}"
 PORT = int(os.environ.get('PORT', 8000))
 
+# Webhook mode is used when a public URL is known, otherwise long polling.
+# Railway exposes the service's domain as RAILWAY_PUBLIC_DOMAIN.
+RAILWAY_PUBLIC_DOMAIN = os.environ.get('RAILWAY_PUBLIC_DOMAIN')
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL') or (f"https://{RAILWAY_PUBLIC_DOMAIN}" if RAILWAY_PUBLIC_DOMAIN else None)
+# The webhook is re-registered on every start, so a fresh secret per process works
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET') or secrets.token_urlsafe(32)
+WEBHOOK_PATH = f'/webhook/{WEBHOOK_SECRET}'
+
 # Setup logging
 logging.basicConfig(
     level=logging.INFO,
@@ -36,32 +54,38 @@ if not TELEGRAM_TOKEN:
 if not ADMIN_CHAT_ID:
     logger.warning("⚠️ ADMIN_CHAT_ID not set, admin features disabled")
 
+# Telegram sends chat IDs as ints, so compare against a pre-parsed int
+try:
+    ADMIN_CHAT_ID_INT = int(ADMIN_CHAT_ID) if ADMIN_CHAT_ID else None
+except ValueError:
+    logger.warning("⚠️ ADMIN_CHAT_ID is not a numeric chat ID, admin features disabled")
+    ADMIN_CHAT_ID_INT = None
+
 # CSV file paths
-ORDERS_CSV = 'orders.csv'
+ORDERS_CSV = 'orders.csv'  # only read once, to import orders into ORDERS_DB
 PRICES_CSV = 'prices.csv'
 
+# SQLite database holding every order; the orders CSV is exported from it
+ORDERS_DB = 'freshmart.db'
+
+ORDERS_CSV_HEADER = [
+    'Order ID', 'Order Date', 'Chat ID', 'Customer Name', 'Phone', 'Address',
+    'Items', 'Quantities', 'Subtotal', 'Delivery Fee', 'Total',
+    'Status', 'Special Instructions', 'Payment Method', 'Source'
+]
+PRICES_CSV_HEADER = ['Category', 'Item Name', 'Price', 'Unit']
+
 # Initialize CSV files
 def initialize_csv_files():
     """Initialize CSV files with headers if they don't exist"""
     try:
-        # Orders CSV
-        if not os.path.exists(ORDERS_CSV):
-            with open(ORDERS_CSV, 'w', newline='', encoding='utf-8') as file:
-                writer = csv.writer(file)
-                writer.writerow([
-                    'Order ID', 'Order Date', 'Chat ID', 'Customer Name', 'Phone', 'Address',
-                    'Items', 'Quantities', 'Subtotal', 'Delivery Fee', 'Total',
-                    'Status', 'Special Instructions', 'Payment Method', 'Source'
-                ])
-            logger.info("✅ Orders CSV initialized!")
-        
         # Prices CSV
         if not os.path.exists(PRICES_CSV):
             save_prices_to_csv()
             logger.info("✅ Prices CSV initialized!")
             
     except Exception as e:
-        logger.error(f"❌ CSV initialization failed: {e}")
+        logger.error("❌ CSV initialization failed: %s", e)
 
 # Grocery database - Default items
 grocery_categories = {
@@ -86,73 +110,168 @@ grocery_categories = {
     }
 }
 
+# Flat item name -> (category, details) lookup, kept in sync with grocery_categories
+item_index = {}
+
+def rebuild_item_index():
+    """Rebuild the flat item lookup from grocery_categories"""
+    global item_index
+    item_index = {
+        item_name: (category, details)
+        for category, items in list(grocery_categories.items())
+        for item_name, details in list(items.items())
+    }
+
+rebuild_item_index()
+
+# Menus rendered from the catalogue are cached until it next changes
+catalog_version = 0
+_catalog_cache = {}
+
+def catalog_changed():
+    """Invalidate everything rendered from grocery_categories"""
+    global catalog_version
+    catalog_version += 1
+
+def cached_catalog_render(key, render):
+    """Return render()'s result, reusing it until catalog_changed() is called"""
+    # Read the version first: if the catalogue changes mid-render, the result
+    # is stored under the old version and rebuilt on the next call
+    version = catalog_version
+    cached = _catalog_cache.get(key)
+    if cached and cached[0] == version:
+        return cached[1]
+    value = render()
+    _catalog_cache[key] = (version, value)
+    return value
+
 def load_prices_from_csv():
     """Load prices from CSV file"""
     global grocery_categories
     try:
         if os.path.exists(PRICES_CSV):
             with open(PRICES_CSV, 'r', encoding='utf-8') as file:
-                reader = csv.DictReader(file)
+                # Columns are in the fixed order written by save_prices_to_csv
+                reader = csv.reader(file)
+                next(reader, None)  # Skip header
                 loaded_categories = {}
                 
-                for row in reader:
-                    category = row['Category']
-                    item_name = row['Item Name']
-                    price = float(row['Price'])
-                    unit = row['Unit']
-                    
-                    if category not in loaded_categories:
-                        loaded_categories[category] = {}
-                    
-                    loaded_categories[category][item_name] = {
-                        'price': price,
+                for category, item_name, price, unit in reader:
+                    loaded_categories.setdefault(category, {})[item_name] = {
+                        'price': float(price),
                         'unit': unit
                     }
                 
                 # Only update if we successfully loaded data
                 if loaded_categories:
                     grocery_categories = loaded_categories
+                    rebuild_item_index()
+                    catalog_changed()
             
             logger.info("✅ Prices loaded from CSV successfully!")
             return True
     except Exception as e:
-        logger.error(f"❌ Failed to load prices from CSV: {e}")
+        logger.error("❌ Failed to load prices from CSV: %s", e)
         # Keep existing categories if loading fails
     return False
 
 def save_prices_to_csv():
     """Save current prices to CSV file"""
     try:
-        with open(PRICES_CSV, 'w', newline='', encoding='utf-8') as file:
+        rows = [
+            [category, item_name, details['price'], details['unit']]
+            for category, items in list(grocery_categories.items())
+            for item_name, details in list(items.items())
+        ]
+        
+        # The whole file fits in the buffer, so it goes out in one write
+        with open(PRICES_CSV, 'w', newline='', encoding='utf-8', buffering=1 << 16) as file:
             writer = csv.writer(file)
-            writer.writerow(['Category', 'Item Name', 'Price', 'Unit'])
-            
-            for category, items in grocery_categories.items():
-                for item_name, details in items.items():
-                    writer.writerow([
-                        category,
-                        item_name,
-                        details['price'],
-                        details['unit']
-                    ])
+            writer.writerow(PRICES_CSV_HEADER)
+            writer.writerows(rows)
         
         logger.info("✅ Prices saved to CSV successfully!")
         return True
     except Exception as e:
-        logger.error(f"❌ Failed to save prices to CSV: {e}")
+        logger.error("❌ Failed to save prices to CSV: %s", e)
         return False
 
+# Admin edits only mark the prices dirty; a background thread rewrites the
+# CSV shortly after, so a burst of edits shares one write and replies never
+# wait on disk
+PRICES_SAVE_DELAY = 2
+_prices_dirty = threading.Event()
+_prices_save_lock = threading.Lock()
+
+def schedule_prices_save():
+    """Queue a background rewrite of the prices CSV"""
+    _prices_dirty.set()
+
+def flush_prices_save():
+    """Write pending price changes now, keeping them queued if the write fails"""
+    with _prices_save_lock:
+        if _prices_dirty.is_set():
+            _prices_dirty.clear()
+            if not save_prices_to_csv():
+                _prices_dirty.set()
+
+def prices_save_worker():
+    """Coalesce queued price saves into one write every PRICES_SAVE_DELAY seconds"""
+    while True:
+        _prices_dirty.wait()
+        time.sleep(PRICES_SAVE_DELAY)
+        flush_prices_save()
+
 # Initialize CSV files and load prices
 initialize_csv_files()
 load_prices_from_csv()
 
-user_carts = {}
-user_sessions = {}
+class LRUDict(OrderedDict):
+    """Dict that drops its least recently used entries once maxsize is exceeded"""
+    
+    def __init__(self, maxsize):
+        super().__init__()
+        self.maxsize = maxsize
+        # Updates for different chats are handled on separate threads
+        self._lock = threading.RLock()
+    
+    def __getitem__(self, key):
+        with self._lock:
+            value = super().__getitem__(key)
+            self.move_to_end(key)
+            return value
+    
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self:
+                return self[key]
+            return default
+    
+    def __setitem__(self, key, value):
+        with self._lock:
+            super().__setitem__(key, value)
+            self.move_to_end(key)
+            while len(self) > self.maxsize:
+                self.popitem(last=False)
+
+# Carts and sessions of recently active users are kept in memory; every
+# user's state is also saved to the user_state table so it survives restarts
+MAX_ACTIVE_USERS = 5000
+SESSION_TTL = 30 * 60  # seconds
+CART_TTL = 7 * 24 * 60 * 60
+user_carts = LRUDict(MAX_ACTIVE_USERS)
+user_sessions = LRUDict(MAX_ACTIVE_USERS)
+# Orders and the catalogue are shared by every update worker; loops over
+# them iterate list() snapshots so another worker's insert can't break them
 order_tracking = {}
+orders_by_user = {}  # chat_id -> order IDs, oldest first
 last_update_id = 0
 
 # ==================== HEALTH CHECK ENDPOINT ====================
 class HealthHandler(BaseHTTPRequestHandler):
+    # Don't let a stalled client hold one of the server's workers forever
+    timeout = 10
+    
     def do_GET(self):
         if self.path == '/health':
             self.send_response(200)
@@ -163,68 +282,428 @@ class HealthHandler(BaseHTTPRequestHandler):
             self.send_response(404)
             self.end_headers()
     
+    def do_POST(self):
+        """Receive updates pushed by Telegram in webhook mode"""
+        if self.path != WEBHOOK_PATH:
+            self.send_response(404)
+            self.end_headers()
+            return
+        
+        # Constant-time comparison so response timing doesn't leak the secret;
+        # compared as bytes because compare_digest rejects non-ASCII str
+        token = self.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not secrets.compare_digest(token.encode(), WEBHOOK_SECRET.encode()):
+            logger.warning("⚠️ Rejected webhook request with bad secret token")
+            self.send_response(403)
+            self.end_headers()
+            return
+        
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            update = orjson.loads(self.rfile.read(length))
+        except (ValueError, orjson.JSONDecodeError):
+            self.send_response(400)
+            self.end_headers()
+            return
+        
+        # Acknowledge right away so Telegram doesn't redeliver while we work
+        enqueue_update(update)
+        self.send_response(200)
+        self.end_headers()
+    
     def log_message(self, format, *args):
-        logger.info("🩺 Health check from %s", self.address_string())
+        path = getattr(self, 'path', None)
+        if path == '/health':
+            logger.info("🩺 Health check from %s", self.address_string())
+        elif path == WEBHOOK_PATH:
+            # The request line carries the secret, so leave it out; the update itself is logged on dispatch
+            logger.debug("📡 Webhook request from %s", self.address_string())
+        else:
+            logger.debug("🌐 %s - %s", self.address_string(), format % args)
+
+class BoundedThreadingHTTPServer(ThreadingHTTPServer):
+    """ThreadingHTTPServer that handles requests on a fixed-size worker pool"""
+    
+    def __init__(self, server_address, handler_class, max_workers=16):
+        # Created first: a failed bind calls server_close() from the base __init__
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='http')
+        super().__init__(server_address, handler_class)
+    
+    def process_request(self, request, client_address):
+        self._pool.submit(self.process_request_thread, request, client_address)
+    
+    def server_close(self):
+        super().server_close()
+        self._pool.shutdown(wait=False)
 
 def start_health_check_server():
-    """Start a simple HTTP server for health checks"""
+    """Bind the health/webhook server and serve it on a daemon thread; returns the thread, or None if it can't start"""
     try:
-        server = HTTPServer(('0.0.0.0', PORT), HealthHandler)
-        logger.info(f"🩺 Health check server running on port {PORT}")
-        server.serve_forever()
+        server = BoundedThreadingHTTPServer(('0.0.0.0', PORT), HealthHandler)
     except Exception as e:
-        logger.error(f"❌ Health check server failed: {e}")
+        logger.error("❌ Health check server failed: %s", e)
+        return None
+    
+    thread = threading.Thread(target=server.serve_forever, name='http', daemon=True)
+    thread.start()
+    logger.info("🩺 Health check server running on port %s", PORT)
+    return thread
 
 # ==================== ORDER TRACKING SYSTEM ====================
+# Several workers can check out in the same second, so IDs use nanoseconds
+# and never repeat within the process even if the clock doesn't advance
+_last_order_ns = 0
+_order_id_lock = threading.Lock()
+
 def generate_order_id():
     """Generate unique order ID"""
-    return f"ORD{int(time.time())}"
+    global _last_order_ns
+    with _order_id_lock:
+        _last_order_ns = max(time.time_ns(), _last_order_ns + 1)
+        return f"ORD{_last_order_ns}"
 
-def save_order_tracking(order_id, chat_id, customer_name, phone, address, cart, total, status="Pending"):
+def save_order_tracking(order_id, chat_id, customer_name, phone, address, cart, total, status="Pending", order_time=None,
+                        subtotal=None, delivery_fee=None, special_instructions=""):
     """Save order to tracking system"""
-    order_tracking[order_id] = {
+    now_str = order_time or datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    
+    order = {
         'chat_id': chat_id,
         'customer_name': customer_name,
         'phone': phone,
         'address': address,
-        'cart': cart.copy(),
+        'cart': cart,  # Owned by the order from here on; checkout drops the user's reference
+        'items_text': render_order_items(cart),
+        'subtotal': subtotal,
+        'delivery_fee': delivery_fee,
         'total': total,
         'status': status,
-        'created_at': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        'updated_at': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        'special_instructions': special_instructions,
+        'created_at': now_str,
+        'updated_at': now_str
     }
+    orders_by_user.setdefault(chat_id, []).append(order_id)
+    order_tracking[order_id] = order
+    insert_order_to_db(order_id, order)
     return order_id
 
-def update_order_status(order_id, new_status, admin_note=""):
-    """Update order status and notify customer"""
-    if order_id not in order_tracking:
+def render_order_items(cart):
+    """Render the item lines shown in the admin details view"""
+    return "".join(
+        f"\n• {item_name} - {details['quantity']} {details['unit']}"
+        for item_name, details in cart.items()
+    )
+
+# ==================== ORDER DATABASE ====================
+order_db = None
+_order_db_lock = threading.Lock()
+
+def init_order_db():
+    """Open the order database and create the orders table if needed"""
+    global order_db
+    try:
+        order_db = sqlite3.connect(ORDERS_DB, check_same_thread=False, isolation_level=None)
+        order_db.execute("PRAGMA journal_mode=WAL")
+        order_db.execute("PRAGMA synchronous=NORMAL")
+        order_db.execute("""CREATE TABLE IF NOT EXISTS orders (
+            order_id TEXT PRIMARY KEY,
+            chat_id INTEGER,
+            customer_name TEXT,
+            phone TEXT,
+            address TEXT,
+            cart_json TEXT,
+            total REAL,
+            status TEXT,
+            created_at TEXT,
+            updated_at TEXT,
+            subtotal REAL,
+            delivery_fee REAL,
+            special_instructions TEXT
+        )""")
+        order_db.execute("""CREATE TABLE IF NOT EXISTS user_state (
+            chat_id INTEGER PRIMARY KEY,
+            session_json TEXT,
+            cart_json TEXT,
+            updated_at REAL
+        )""")
+        
+        # Databases created before the CSV columns moved here lack them
+        columns = {row[1] for row in order_db.execute("PRAGMA table_info(orders)")}
+        for column, column_type in (('subtotal', 'REAL'), ('delivery_fee', 'REAL'), ('special_instructions', 'TEXT')):
+            if column not in columns:
+                order_db.execute(f"ALTER TABLE orders ADD COLUMN {column} {column_type}")
+        
+        logger.info("✅ Order database ready!")
+        return True
+    except Exception as e:
+        logger.error("❌ Order database initialization failed: %s", e)
+        order_db = None
+        return False
+
+def load_order_tracking():
+    """Restore order_tracking from the order database"""
+    if not order_db:
         return False
     
-    order = order_tracking[order_id]
-    old_status = order['status']
-    order['status'] = new_status
-    order['updated_at'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    try:
+        with _order_db_lock:
+            rows = order_db.execute(
+                "SELECT order_id, chat_id, customer_name, phone, address, cart_json, total, status, "
+                "created_at, updated_at, subtotal, delivery_fee, special_instructions FROM orders ORDER BY rowid"
+            ).fetchall()
+        
+        for (order_id, chat_id, customer_name, phone, address, cart_json, total, status,
+             created_at, updated_at, subtotal, delivery_fee, special_instructions) in rows:
+            cart = orjson.loads(cart_json)
+            order_tracking[order_id] = {
+                'chat_id': chat_id,
+                'customer_name': customer_name,
+                'phone': phone,
+                'address': address,
+                'cart': cart,
+                'items_text': render_order_items(cart),
+                'subtotal': subtotal,
+                'delivery_fee': delivery_fee,
+                'total': total,
+                'status': status,
+                'special_instructions': special_instructions or "",
+                'created_at': created_at,
+                'updated_at': updated_at
+            }
+            orders_by_user.setdefault(chat_id, []).append(order_id)
+        
+        logger.info("✅ Loaded %s tracked order(s) from database", len(rows))
+        return True
+    except Exception as e:
+        logger.error("❌ Failed to load orders from database: %s", e)
+        return False
+
+# Bumped on every order write so the cached CSV export knows to rebuild
+orders_version = 0
+_orders_export_cache = {'version': None, 'data': b''}
+_orders_export_lock = threading.Lock()
+
+def orders_changed():
+    """Invalidate the cached orders export"""
+    global orders_version
+    orders_version += 1
+
+def insert_order_to_db(order_id, order):
+    """Insert a new tracked order into the database"""
+    if not order_db:
+        return False
     
-    # Update CSV file
-    update_order_in_csv(order_id, 'Status', new_status)
+    try:
+        with _order_db_lock:
+            # Plain INSERT: a duplicate ID must fail rather than overwrite an order
+            order_db.execute(
+                "INSERT INTO orders (order_id, chat_id, customer_name, phone, address, "
+                "cart_json, total, status, created_at, updated_at, subtotal, delivery_fee, special_instructions) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    order_id, order['chat_id'], order['customer_name'], order['phone'],
+                    order['address'], orjson.dumps(order['cart']).decode(), order['total'],
+                    order['status'], order['created_at'], order['updated_at'],
+                    order['subtotal'], order['delivery_fee'], order['special_instructions']
+                )
+            )
+            orders_changed()
+        return True
+    except Exception as e:
+        logger.error("❌ Failed to save order to database: %s", e)
+        return False
+
+def update_order_status_in_db(order_id, status, updated_at):
+    """Update the stored status of a tracked order"""
+    if not order_db:
+        return False
     
-    # Notify customer
-    notify_customer_order_update(order_id, new_status, admin_note)
+    try:
+        with _order_db_lock:
+            order_db.execute(
+                "UPDATE orders SET status = ?, updated_at = ? WHERE order_id = ?",
+                (status, updated_at, order_id)
+            )
+            orders_changed()
+        return True
+    except Exception as e:
+        logger.error("❌ Failed to update order in database: %s", e)
+        return False
+
+def restore_user_state(chat_id):
+    """Load whichever of a user's saved session and cart isn't already in memory"""
+    # The two LRU dicts evict independently, so either one may be missing
+    need_session = chat_id not in user_sessions
+    need_cart = chat_id not in user_carts
+    if not order_db or not (need_session or need_cart):
+        return
     
-    logger.info(f"✅ Order {order_id} status updated: {old_status} → {new_status}")
-    return True
+    try:
+        with _order_db_lock:
+            row = order_db.execute(
+                "SELECT session_json, cart_json, updated_at FROM user_state WHERE chat_id = ?",
+                (chat_id,)
+            ).fetchone()
+        if not row:
+            return
+        
+        session_json, cart_json, updated_at = row
+        age = time.time() - updated_at
+        if need_session and session_json and age < SESSION_TTL:
+            user_sessions[chat_id] = orjson.loads(session_json)
+        if need_cart and cart_json and age < CART_TTL:
+            user_carts[chat_id] = orjson.loads(cart_json)
+    except Exception as e:
+        logger.error("❌ Failed to restore state for %s: %s", chat_id, e)
 
-def notify_customer_order_update(order_id, new_status, admin_note=""):
-    """Notify customer about order status update"""
-    order = order_tracking.get(order_id)
-    if not order:
+def save_user_state(chat_id):
+    """Write a user's current session and cart to the database"""
+    if not order_db:
         return
     
-    chat_id = order['chat_id']
-    customer_name = order['customer_name']
+    session = user_sessions.get(chat_id)
+    cart = user_carts.get(chat_id)
+    try:
+        with _order_db_lock:
+            if not session and not cart:
+                order_db.execute("DELETE FROM user_state WHERE chat_id = ?", (chat_id,))
+                return
+            
+            order_db.execute(
+                "INSERT OR REPLACE INTO user_state (chat_id, session_json, cart_json, updated_at) "
+                "VALUES (?, ?, ?, ?)",
+                (
+                    chat_id,
+                    orjson.dumps(session).decode() if session else None,
+                    orjson.dumps(cart).decode() if cart else None,
+                    time.time()
+                )
+            )
+    except Exception as e:
+        logger.error("❌ Failed to save state for %s: %s", chat_id, e)
+
+def import_orders_csv():
+    """One-time import of orders logged to ORDERS_CSV before the database existed"""
+    if not order_db or not os.path.exists(ORDERS_CSV):
+        return False
+    
+    try:
+        rows = []
+        skipped = 0
+        with open(ORDERS_CSV, 'r', encoding='utf-8') as file:
+            reader = csv.reader(file)
+            next(reader, None)  # Skip header
+            for line_number, row in enumerate(reader, start=2):
+                try:
+                    (order_id, order_date, chat_id, customer_name, phone, address, items, quantities,
+                     subtotal, delivery_fee, total, status, special_instructions) = row[:13]
+                    
+                    # The CSV has no unit prices, only names and "<qty> <unit>";
+                    # orders whose cart was cleared during checkout have neither
+                    cart = {}
+                    if items:
+                        for item_name, quantity in zip(items.split(", "), quantities.split(", ")):
+                            qty, _, unit = quantity.partition(' ')
+                            cart[item_name] = {'quantity': int(qty), 'unit': unit}
+                    
+                    rows.append((
+                        order_id, int(chat_id), customer_name, phone, address, orjson.dumps(cart).decode(),
+                        float(total), status, order_date, order_date,
+                        float(subtotal), float(delivery_fee), special_instructions
+                    ))
+                except ValueError as e:
+                    # One bad legacy row shouldn't keep every other order out
+                    logger.warning("⚠️ Skipping unreadable order on line %s of %s: %s", line_number, ORDERS_CSV, e)
+                    skipped += 1
+        
+        with _order_db_lock:
+            order_db.execute("BEGIN")
+            order_db.executemany(
+                "INSERT INTO orders (order_id, chat_id, customer_name, phone, address, "
+                "cart_json, total, status, created_at, updated_at, subtotal, delivery_fee, special_instructions) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                # Orders already tracked in the database only pick up the CSV-only columns
+                "ON CONFLICT(order_id) DO UPDATE SET "
+                "subtotal = COALESCE(orders.subtotal, excluded.subtotal), "
+                "delivery_fee = COALESCE(orders.delivery_fee, excluded.delivery_fee), "
+                "special_instructions = COALESCE(orders.special_instructions, excluded.special_instructions)",
+                rows
+            )
+            order_db.execute("COMMIT")
+        
+        # Keep the original file around, but don't import it again
+        os.replace(ORDERS_CSV, ORDERS_CSV + '.imported')
+        logger.info("✅ Imported %s order(s) from CSV into database, skipped %s", len(rows), skipped)
+        return True
+    except Exception as e:
+        logger.error("❌ Failed to import orders from CSV: %s", e)
+        if order_db.in_transaction:
+            order_db.execute("ROLLBACK")
+        return False
+
+def export_orders_csv():
+    """Write every stored order to a temporary CSV file, returned open for reading"""
+    if not order_db:
+        return None
     
-    status_messages = {
-        'Shipped': f"""🚚 Order Shipped! 
+    with _order_db_lock:
+        rows = order_db.execute(
+            "SELECT order_id, created_at, chat_id, customer_name, phone, address, cart_json, "
+            "subtotal, delivery_fee, total, status, special_instructions FROM orders ORDER BY rowid"
+        ).fetchall()
+    
+    file = tempfile.TemporaryFile()
+    text = io.TextIOWrapper(file, encoding='utf-8', newline='')
+    writer = csv.writer(text)
+    writer.writerow(ORDERS_CSV_HEADER)
+    for (order_id, created_at, chat_id, customer_name, phone, address, cart_json,
+         subtotal, delivery_fee, total, status, special_instructions) in rows:
+        cart = orjson.loads(cart_json)
+        writer.writerow([
+            order_id,
+            created_at,
+            str(chat_id),
+            customer_name,
+            phone,
+            address,
+            ", ".join(cart),
+            ", ".join(f"{details['quantity']} {details['unit']}" for details in cart.values()),
+            f"{subtotal:.2f}" if subtotal is not None else "",
+            f"{delivery_fee:.2f}" if delivery_fee is not None else "",
+            f"{total:.2f}",
+            status,
+            special_instructions or "",
+            "Cash on Delivery",
+            "Telegram Bot"
+        ])
+    
+    text.flush()
+    text.detach()
+    file.seek(0)
+    return file
+
+def get_orders_export():
+    """Return the orders CSV for download, regenerating it only after orders change"""
+    with _orders_export_lock:
+        version = orders_version
+        if _orders_export_cache['version'] != version:
+            file = export_orders_csv()
+            if file is None:
+                return None
+            with file:
+                _orders_export_cache['data'] = file.read()
+            _orders_export_cache['version'] = version
+        return io.BytesIO(_orders_export_cache['data'])
+
+# Open the order database, pull in any legacy CSV orders and restore tracking
+init_order_db()
+import_orders_csv()
+load_order_tracking()
+
+# ==================== ORDER STATUS UPDATES ====================
+# Customer notifications per status; only the selected one is formatted
+STATUS_MESSAGE_TEMPLATES = {
+    'Shipped': """🚚 Order Shipped! 
 
 Hi {customer_name},
 
@@ -232,26 +711,26 @@ Your order #{order_id} is on the way!
 
 📦 Delivery Details:
 • Order will arrive within 2 hours
-• Please have ${order['total']:.2f} ready for cash payment
+• Please have ${total:.2f} ready for cash payment
 • Contact: 555-1234 if any issues
 
-{f'📝 Note from store: {admin_note}' if admin_note else ''}
+{note}
 
 Thank you for choosing FreshMart! 🛒""",
-        
-        'Cancelled': f"""❌ Order Cancelled
+    
+    'Cancelled': """❌ Order Cancelled
 
 Hi {customer_name},
 
 We're sorry to inform you that your order #{order_id} has been cancelled.
 
-{f'📝 Reason: {admin_note}' if admin_note else '📝 Reason: Unable to fulfill order at this time'}
+{note}
 
 We apologize for the inconvenience.
 
 FreshMart Team 🛒""",
-        
-        'Delivered': f"""✅ Order Delivered! 
+    
+    'Delivered': """✅ Order Delivered! 
 
 Hi {customer_name},
 
@@ -260,108 +739,73 @@ Your order #{order_id} has been successfully delivered!
 Thank you for shopping with FreshMart! 🛒
 
 We hope to serve you again soon! 🌟"""
-    }
-    
-    message = status_messages.get(new_status)
-    if message:
-        send_message(chat_id, message)
+}
 
-# ==================== CSV ORDER MANAGEMENT ====================
-def save_order_to_csv(chat_id, customer_name, phone, address, cart, special_instructions="", order_id=""):
-    """Save order to CSV file"""
-    logger.info(f"📦 Order received: {customer_name}, ${sum(details['price'] * details['quantity'] for details in cart.values()):.2f}")
+def notify_customer_order_update(order_id, new_status, admin_note=""):
+    """Notify customer about order status update"""
+    order = order_tracking.get(order_id)
+    if not order:
+        return
     
-    try:
-        subtotal = sum(details['price'] * details['quantity'] for details in cart.values())
-        delivery_fee = 0 if subtotal >= 50 else 5
-        total = subtotal + delivery_fee
-
-        # Format items and quantities
-        items_list = []
-        quantities_list = []
-        for item_name, details in cart.items():
-            items_list.append(item_name)
-            quantities_list.append(f"{details['quantity']} {details['unit']}")
-
-        # Prepare order data
-        order_data = [
-            order_id,
-            datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            str(chat_id),
-            customer_name,
-            phone,
-            address,
-            ", ".join(items_list),
-            ", ".join(quantities_list),
-            f"{subtotal:.2f}",
-            f"{delivery_fee:.2f}",
-            f"{total:.2f}",
-            "Pending",
-            special_instructions,
-            "Cash on Delivery",
-            "Telegram Bot"
-        ]
-
-        # Append to CSV
-        with open(ORDERS_CSV, 'a', newline='', encoding='utf-8') as file:
-            writer = csv.writer(file)
-            writer.writerow(order_data)
-        
-        logger.info("✅ Order saved to CSV successfully!")
-        return True
-        
-    except Exception as e:
-        logger.error(f"❌ CSV save failed: {e}")
-        return False
-
-def update_order_in_csv(order_id, field, new_value):
-    """Update specific field of an order in CSV"""
-    try:
-        # Read all orders
-        orders = []
-        with open(ORDERS_CSV, 'r', encoding='utf-8') as file:
-            reader = csv.DictReader(file)
-            orders = list(reader)
-        
-        # Find and update the order
-        for order in orders:
-            if order['Order ID'] == order_id:
-                if field == 'Status':
-                    order['Status'] = new_value
-                break
-        
-        # Write back to CSV
-        with open(ORDERS_CSV, 'w', newline='', encoding='utf-8') as file:
-            if orders:
-                writer = csv.DictWriter(file, fieldnames=orders[0].keys())
-                writer.writeheader()
-                writer.writerows(orders)
-        
-        return True
-    except Exception as e:
-        logger.error(f"❌ Failed to update order in CSV: {e}")
-        return False
-
+    template = STATUS_MESSAGE_TEMPLATES.get(new_status)
+    if not template:
+        return
+    
+    if new_status == 'Cancelled':
+        note = f'📝 Reason: {admin_note}' if admin_note else '📝 Reason: Unable to fulfill order at this time'
+    else:
+        note = f'📝 Note from store: {admin_note}' if admin_note else ''
+    
+    message = template.format(
+        customer_name=order['customer_name'],
+        order_id=order_id,
+        total=order['total'],
+        note=note
+    )
+    send_message(order['chat_id'], message)
+
+# ==================== CSV DOWNLOADS ====================
 def get_csv_file(file_type):
-    """Get CSV file as bytes for download"""
+    """Open CSV file for download; the caller closes the returned handle"""
     try:
         if file_type == 'orders':
-            filename = ORDERS_CSV
+            return get_orders_export()
         elif file_type == 'prices':
+            # Include edits still waiting on the background save
+            flush_prices_save()
             filename = PRICES_CSV
         else:
             return None
         
-        with open(filename, 'rb') as file:
-            return file.read()
+        return open(filename, 'rb')
     except Exception as e:
-        logger.error(f"❌ Failed to read CSV file: {e}")
+        logger.error("❌ Failed to open CSV file: %s", e)
         return None
 
 # ==================== ADMIN ORDER MANAGEMENT ====================
+def create_admin_order_summary(order_id, order_data):
+    """Summarize a tracked order's customer, items and totals for the admin"""
+    if order_data['subtotal'] is not None:
+        pricing = (
+            f"💵 Subtotal: ${order_data['subtotal']:.2f}\n"
+            f"🚚 Delivery Fee: ${order_data['delivery_fee']:.2f}\n"
+        )
+    else:
+        pricing = ""
+    
+    return f"""👤 Customer: {order_data['customer_name']}
+📞 Phone: {order_data['phone']}
+📍 Address: {order_data['address']}
+
+📦 Order Items:{order_data['items_text']}
+
+{pricing}💰 Total: ${order_data['total']:.2f}
+💵 Payment: Cash on Delivery
+📝 Special Instructions: {order_data['special_instructions'] or 'None'}"""
+
 def send_admin_order_notification(order_id, order_data):
     """Send new order notification to admin with action buttons"""
-    if not ADMIN_CHAT_ID:
+    if ADMIN_CHAT_ID_INT is None:
         return
         
     order_summary = create_admin_order_summary(order_id, order_data)
@@ -394,7 +838,7 @@ def send_admin_order_notification(order_id, order_data):
             [{'text': '📋 View Details', 'callback_data': f'details_{order_id}'}]
         ]
     
-    send_message(ADMIN_CHAT_ID, admin_message, inline_keyboard=inline_keyboard)
+    send_message(ADMIN_CHAT_ID_INT, admin_message, inline_keyboard=inline_keyboard)
 
 def update_order_status(order_id, new_status, admin_note=""):
     """Update order status and notify customer"""
@@ -406,8 +850,8 @@ def update_order_status(order_id, new_status, admin_note=""):
     order['status'] = new_status
     order['updated_at'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     
-    # Update CSV file
-    update_order_in_csv(order_id, 'Status', new_status)
+    # Update database
+    update_order_status_in_db(order_id, new_status, order['updated_at'])
     
     # Notify customer
     notify_customer_order_update(order_id, new_status, admin_note)
@@ -416,53 +860,48 @@ def update_order_status(order_id, new_status, admin_note=""):
     try:
         send_admin_order_notification(order_id, order)
     except Exception as e:
-        logger.warning(f"⚠️ Admin notification update failed: {e}")
+        logger.warning("⚠️ Admin notification update failed: %s", e)
     
-    logger.info(f"✅ Order {order_id} status updated: {old_status} → {new_status}")
+    logger.info("✅ Order %s status updated: %s → %s", order_id, old_status, new_status)
     return True
 
-def handle_admin_callback(chat_id, callback_data):
-    """Handle admin action callbacks"""
-    if not is_admin(chat_id):
-        send_message(chat_id, "❌ Unauthorized access.")
+def admin_ship_order(chat_id, order_id):
+    """Mark order as shipped"""
+    if update_order_status(order_id, 'Shipped', 'Your order is on the way!'):
+        send_message(chat_id, f"✅ Order #{order_id} marked as shipped! Customer notified.")
+    else:
+        send_message(chat_id, f"❌ Order #{order_id} not found.")
+
+def admin_cancel_order(chat_id, order_id):
+    """Ask admin for the cancellation reason"""
+    user_sessions[chat_id] = {
+        'step': 'awaiting_cancel_reason',
+        'order_id': order_id
+    }
+    send_message(chat_id, f"📝 Please provide reason for cancelling order #{order_id}:")
+
+def admin_deliver_order(chat_id, order_id):
+    """Mark order as delivered"""
+    if update_order_status(order_id, 'Delivered'):
+        send_message(chat_id, f"✅ Order #{order_id} marked as delivered! Customer notified.")
+    else:
+        send_message(chat_id, f"❌ Order #{order_id} not found.")
+
+def admin_show_order_details(chat_id, order_id):
+    """Show full order details with the actions still available"""
+    order = order_tracking.get(order_id)
+    if not order:
+        send_message(chat_id, f"❌ Order #{order_id} not found.")
         return
     
-    try:
-        if callback_data.startswith('ship_'):
-            order_id = callback_data[5:]
-            if update_order_status(order_id, 'Shipped', 'Your order is on the way!'):
-                send_message(chat_id, f"✅ Order #{order_id} marked as shipped! Customer notified.")
-            else:
-                send_message(chat_id, f"❌ Order #{order_id} not found.")
-                
-        elif callback_data.startswith('cancel_'):
-            order_id = callback_data[7:]
-            # Ask for cancellation reason
-            user_sessions[chat_id] = {
-                'step': 'awaiting_cancel_reason',
-                'order_id': order_id
-            }
-            send_message(chat_id, f"📝 Please provide reason for cancelling order #{order_id}:")
-            
-        elif callback_data.startswith('deliver_'):
-            order_id = callback_data[8:]
-            if update_order_status(order_id, 'Delivered'):
-                send_message(chat_id, f"✅ Order #{order_id} marked as delivered! Customer notified.")
-            else:
-                send_message(chat_id, f"❌ Order #{order_id} not found.")
-                
-        elif callback_data.startswith('details_'):
-            order_id = callback_data[8:]
-            order = order_tracking.get(order_id)
-            if order:
-                status_emoji = {
-                    'Pending': '⏳',
-                    'Shipped': '🚚',
-                    'Delivered': '✅',
-                    'Cancelled': '❌'
-                }.get(order['status'], '📦')
-                
-                details = f"""📋 Order Details #{order_id}
+    status_emoji = {
+        'Pending': '⏳',
+        'Shipped': '🚚',
+        'Delivered': '✅',
+        'Cancelled': '❌'
+    }.get(order['status'], '📦')
+    
+    details = f"""📋 Order Details #{order_id}
 
 {status_emoji} Status: {order['status']}
 👤 Customer: {order['customer_name']}
@@ -472,38 +911,38 @@ def handle_admin_callback(chat_id, callback_data):
 🕐 Created: {order['created_at']}
 🔄 Updated: {order['updated_at']}
 
-📦 Order Items:"""
-                for item_name, item_details in order['cart'].items():
-                    details += f"\n• {item_name} - {item_details['quantity']} {item_details['unit']}"
-                
-                # Show available actions based on current status
-                if order['status'] in ['Pending', 'Shipped']:
-                    details += "\n\nAvailable Actions:"
-                    inline_keyboard = []
-                    if order['status'] == 'Pending':
-                        inline_keyboard.append([
-                            {'text': '🚚 Mark as Shipped', 'callback_data': f'ship_{order_id}'},
-                            {'text': '❌ Cancel Order', 'callback_data': f'cancel_{order_id}'}
-                        ])
-                    inline_keyboard.append([
-                        {'text': '✅ Mark Delivered', 'callback_data': f'deliver_{order_id}'}
-                    ])
-                    send_message(chat_id, details, inline_keyboard=inline_keyboard)
-                else:
-                    # Order is completed (delivered or cancelled)
-                    details += f"\n\n📝 Order {order['status'].lower()} - No further actions available"
-                    send_message(chat_id, details)
-            else:
-                send_message(chat_id, f"❌ Order #{order_id} not found.")
-                
-    except Exception as e:
-        logger.error(f"❌ Admin callback error: {e}")
-        send_message(chat_id, "❌ Error processing admin action.")
+📦 Order Items:{order['items_text']}"""
+    
+    # Show available actions based on current status
+    if order['status'] in ['Pending', 'Shipped']:
+        details += "\n\nAvailable Actions:"
+        inline_keyboard = []
+        if order['status'] == 'Pending':
+            inline_keyboard.append([
+                {'text': '🚚 Mark as Shipped', 'callback_data': f'ship_{order_id}'},
+                {'text': '❌ Cancel Order', 'callback_data': f'cancel_{order_id}'}
+            ])
+        inline_keyboard.append([
+            {'text': '✅ Mark Delivered', 'callback_data': f'deliver_{order_id}'}
+        ])
+        send_message(chat_id, details, inline_keyboard=inline_keyboard)
+    else:
+        # Order is completed (delivered or cancelled)
+        details += f"\n\n📝 Order {order['status'].lower()} - No further actions available"
+        send_message(chat_id, details)
+
+# Order action callbacks look like '<action>_<order_id>'
+ORDER_ACTIONS = {
+    'ship': admin_ship_order,
+    'cancel': admin_cancel_order,
+    'deliver': admin_deliver_order,
+    'details': admin_show_order_details
+}
 
 # ==================== ADMIN PRICE & INVENTORY MANAGEMENT ====================
 def is_admin(chat_id):
     """Check if user is admin"""
-    return ADMIN_CHAT_ID and str(chat_id) == ADMIN_CHAT_ID
+    return ADMIN_CHAT_ID_INT is not None and chat_id == ADMIN_CHAT_ID_INT
 
 def show_admin_panel(chat_id):
     """Show admin management panel"""
@@ -515,14 +954,7 @@ def show_admin_panel(chat_id):
 
 Choose an action:"""
     
-    keyboard = [
-        [{'text': '📊 View All Items'}, {'text': '💰 Update Price'}],
-        [{'text': '🆕 Add New Item'}, {'text': '🗑️ Remove Item'}],
-        [{'text': '📦 View Orders'}, {'text': '📥 Download Data'}],
-        [{'text': '🔄 Refresh Menu'}, {'text': '🔙 Main Menu'}]
-    ]
-    
-    send_message(chat_id, admin_menu, keyboard=keyboard)
+    send_message(chat_id, admin_menu, reply_markup_json=ADMIN_PANEL_MARKUP)
     user_sessions[chat_id] = {'step': 'admin_panel'}
 
 def show_download_panel(chat_id):
@@ -534,46 +966,30 @@ def show_download_panel(chat_id):
 
 Choose which data to download:"""
     
-    inline_keyboard = [
-        [
-            {'text': '📦 Orders CSV', 'callback_data': 'download_orders'},
-            {'text': '💰 Prices CSV', 'callback_data': 'download_prices'}
-        ],
-        [
-            {'text': '📊 Both Files', 'callback_data': 'download_both'},
-            {'text': '🔙 Back', 'callback_data': 'admin_back'}
-        ]
-    ]
-    
-    send_message(chat_id, download_menu, inline_keyboard=inline_keyboard)
+    send_message(chat_id, download_menu, reply_markup_json=DOWNLOAD_PANEL_MARKUP)
 
 def handle_admin_price_update(chat_id, item_name):
     """Start price update process for specific item"""
     if not is_admin(chat_id):
         return
     
-    item_found = False
-    for category, items in grocery_categories.items():
-        if item_name in items:
-            item_found = True
-            current_price = items[item_name]['price']
-            current_unit = items[item_name]['unit']
-            
-            user_sessions[chat_id] = {
-                'step': 'awaiting_new_price',
-                'editing_item': item_name,
-                'item_category': category
-            }
-            
-            send_message(chat_id, 
-                f"💰 Updating Price for: {item_name}\n"
-                f"Current Price: ${current_price}/{current_unit}\n\n"
-                f"Please enter the new price (numbers only):"
-            )
-            break
-    
-    if not item_found:
+    entry = item_index.get(item_name)
+    if not entry:
         send_message(chat_id, "❌ Item not found!")
+        return
+    category, details = entry
+    
+    user_sessions[chat_id] = {
+        'step': 'awaiting_new_price',
+        'editing_item': item_name,
+        'item_category': category
+    }
+    
+    send_message(chat_id, 
+        f"💰 Updating Price for: {item_name}\n"
+        f"Current Price: ${details['price']}/{details['unit']}\n\n"
+        f"Please enter the new price (numbers only):"
+    )
 
 def handle_admin_new_item(chat_id):
     """Start process to add new item"""
@@ -585,7 +1001,7 @@ def handle_admin_new_item(chat_id):
     categories_text = "📋 Select category for new item:"
     inline_keyboard = []
     
-    for category in grocery_categories.keys():
+    for category in list(grocery_categories):
         inline_keyboard.append([{
             'text': category,
             'callback_data': f"newitem_cat_{category}"
@@ -605,7 +1021,7 @@ def handle_admin_remove_item(chat_id):
     categories_text = "🗑️ Select category to remove item from:"
     inline_keyboard = []
     
-    for category in grocery_categories.keys():
+    for category in list(grocery_categories):
         inline_keyboard.append([{
             'text': category,
             'callback_data': f"remove_cat_{category}"
@@ -629,7 +1045,7 @@ def show_remove_items_from_category(chat_id, category):
     items_text = f"🗑️ Remove Item from {category}\n\nSelect item to remove:"
     inline_keyboard = []
     
-    for item_name in items.keys():
+    for item_name in list(items):
         inline_keyboard.append([{
             'text': f"❌ {item_name}",
             'callback_data': f"remove_item_{item_name}"
@@ -642,21 +1058,17 @@ def show_remove_items_from_category(chat_id, category):
 def remove_item_from_category(chat_id, item_name):
     """Remove item from category"""
     try:
-        item_found = False
-        category_to_remove_from = None
+        entry = item_index.get(item_name)
         
-        for category, items in grocery_categories.items():
-            if item_name in items:
-                item_found = True
-                category_to_remove_from = category
-                break
-        
-        if item_found and category_to_remove_from:
+        if entry:
             # Remove the item
+            category_to_remove_from = entry[0]
             del grocery_categories[category_to_remove_from][item_name]
+            del item_index[item_name]
+            catalog_changed()
             
             # Save changes to CSV
-            save_prices_to_csv()
+            schedule_prices_save()
             
             send_message(chat_id, f"✅ Successfully removed: {item_name} from {category_to_remove_from}")
             show_admin_panel(chat_id)
@@ -664,31 +1076,28 @@ def remove_item_from_category(chat_id, item_name):
             send_message(chat_id, "❌ Item not found!")
             
     except Exception as e:
-        logger.error(f"❌ Error removing item: {e}")
+        logger.error("❌ Error removing item: %s", e)
         send_message(chat_id, "❌ Error removing item. Please try again.")
         show_admin_panel(chat_id)
 
-def show_all_items_admin(chat_id):
-    """Show all items with prices to admin"""
-    items_text = "📊 **CURRENT INVENTORY & PRICING**\n\n"
+def render_inventory_text():
+    """Render the full inventory and price list"""
+    parts = ["📊 **CURRENT INVENTORY & PRICING**\n\n"]
     
-    for category, items in grocery_categories.items():
-        items_text += f"**{category}**\n"
-        for item_name, details in items.items():
-            items_text += f"• {item_name} - ${details['price']}/{details['unit']}\n"
-        items_text += "\n"
+    for category, items in list(grocery_categories.items()):
+        parts.append(f"**{category}**\n")
+        for item_name, details in list(items.items()):
+            parts.append(f"• {item_name} - ${details['price']}/{details['unit']}\n")
+        parts.append("\n")
     
-    send_message(chat_id, items_text)
-    show_admin_panel(chat_id)
+    return "".join(parts)
 
-def show_items_for_price_update(chat_id):
-    """Show items with inline buttons for price updates"""
-    items_text = "💰 **UPDATE ITEM PRICES**\n\nSelect item to update:"
-    
+def render_price_update_markup():
+    """Serialize the inline keyboard listing every item for price updates"""
     inline_keyboard = []
     
-    for category, items in grocery_categories.items():
-        for item_name, details in items.items():
+    for category, items in list(grocery_categories.items()):
+        for item_name, details in list(items.items()):
             button_text = f"{item_name} - ${details['price']}/{details['unit']}"
             inline_keyboard.append([{
                 'text': button_text,
@@ -697,7 +1106,26 @@ def show_items_for_price_update(chat_id):
     
     inline_keyboard.append([{'text': '🔙 Back to Admin Panel', 'callback_data': 'admin_back'}])
     
-    send_message(chat_id, items_text, inline_keyboard=inline_keyboard)
+    return build_reply_markup(inline_keyboard=inline_keyboard)
+
+def show_all_items_admin(chat_id):
+    """Show all items with prices to admin"""
+    send_message(chat_id, cached_catalog_render('inventory_text', render_inventory_text))
+    show_admin_panel(chat_id)
+
+def show_items_for_price_update(chat_id):
+    """Show items with inline buttons for price updates"""
+    items_text = "💰 **UPDATE ITEM PRICES**\n\nSelect item to update:"
+    markup = cached_catalog_render('price_update_markup', render_price_update_markup)
+    send_message(chat_id, items_text, reply_markup_json=markup)
+
+def refresh_menu_admin(chat_id):
+    """Reload prices from CSV"""
+    # Write edits still waiting on the background save, or the reload would revert them
+    flush_prices_save()
+    load_prices_from_csv()
+    send_message(chat_id, "✅ Menu refreshed with latest prices!")
+    show_admin_panel(chat_id)
 
 def show_all_orders_admin(chat_id):
     """Show all orders to admin"""
@@ -706,9 +1134,9 @@ def show_all_orders_admin(chat_id):
         show_admin_panel(chat_id)
         return
     
-    orders_text = "📦 **ALL ORDERS**\n\n"
+    parts = ["📦 **ALL ORDERS**\n\n"]
     
-    for order_id, order in order_tracking.items():
+    for order_id, order in list(order_tracking.items()):
         status_emoji = {
             'Pending': '⏳',
             'Shipped': '🚚',
@@ -716,61 +1144,238 @@ def show_all_orders_admin(chat_id):
             'Cancelled': '❌'
         }.get(order['status'], '📦')
         
-        orders_text += f"{status_emoji} **Order #{order_id}**\n"
-        orders_text += f"👤 {order['customer_name']}\n"
-        orders_text += f"📞 {order['phone']}\n"
-        orders_text += f"💰 ${order['total']:.2f}\n"
-        orders_text += f"📊 {order['status']}\n"
-        orders_text += f"🕐 {order['created_at']}\n\n"
-    
-    send_message(chat_id, orders_text)
+        parts.append(
+            f"{status_emoji} **Order #{order_id}**\n"
+            f"👤 {order['customer_name']}\n"
+            f"📞 {order['phone']}\n"
+            f"💰 ${order['total']:.2f}\n"
+            f"📊 {order['status']}\n"
+            f"🕐 {order['created_at']}\n\n"
+        )
+    
+    send_message(chat_id, "".join(parts))
     show_admin_panel(chat_id)
 
 # ==================== MESSAGE HANDLING ====================
-def send_message(chat_id, text, keyboard=None, inline_keyboard=None, parse_mode='HTML'):
-    """Enhanced message sending with comprehensive error handling"""
+# Shared session so Telegram API calls reuse keep-alive connections
+telegram_session = requests.Session()
+telegram_session.mount('https://', HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=50,
+    max_retries=Retry(total=3, backoff_factor=0.2, status_forcelist=[429, 500, 502, 503, 504])
+))
+
+# Request bodies are encoded with orjson and sent as raw data
+JSON_HEADERS = {'Content-Type': 'application/json'}
+
+# Longest flood-control wait (seconds) we'll sit out before retrying a send
+MAX_FLOOD_WAIT = 10
+
+def get_flood_wait(response):
+    """Return Telegram's retry_after for a 429 response, if any"""
+    if response.status_code != 429:
+        return None
+    try:
+        return orjson.loads(response.content).get('parameters', {}).get('retry_after')
+    except Exception:
+        return None
+
+def build_reply_markup(keyboard=None, inline_keyboard=None):
+    """Serialize a reply or inline keyboard to reply_markup JSON"""
+    if keyboard:
+        return orjson.dumps({
+            'keyboard': keyboard,
+            'resize_keyboard': True,
+            'one_time_keyboard': False
+        }).decode()
+    return orjson.dumps({
+        'inline_keyboard': inline_keyboard
+    }).decode()
+
+# Static menus are serialized once instead of on every send
+MAIN_MENU_MARKUP = build_reply_markup(keyboard=[
+    [{'text': '🛍️ Shop Groceries'}, {'text': '🛒 My Cart'}],
+    [{'text': '📦 Track Order'}, {'text': '📞 Contact Store'}],
+    [{'text': 'ℹ️ Store Info'}, {'text': '👨‍💼 Admin Panel'}]
+])
+
+ADMIN_PANEL_MARKUP = build_reply_markup(keyboard=[
+    [{'text': '📊 View All Items'}, {'text': '💰 Update Price'}],
+    [{'text': '🆕 Add New Item'}, {'text': '🗑️ Remove Item'}],
+    [{'text': '📦 View Orders'}, {'text': '📥 Download Data'}],
+    [{'text': '🔄 Refresh Menu'}, {'text': '🔙 Main Menu'}]
+])
+
+DOWNLOAD_PANEL_MARKUP = build_reply_markup(inline_keyboard=[
+    [
+        {'text': '📦 Orders CSV', 'callback_data': 'download_orders'},
+        {'text': '💰 Prices CSV', 'callback_data': 'download_prices'}
+    ],
+    [
+        {'text': '📊 Both Files', 'callback_data': 'download_both'},
+        {'text': '🔙 Back', 'callback_data': 'admin_back'}
+    ]
+])
+
+CATEGORIES_MARKUP = build_reply_markup(keyboard=[
+    [{'text': '🥦 Fresh Produce'}, {'text': '🥩 Meat & Poultry'}],
+    [{'text': '🥛 Dairy & Eggs'}, {'text': '🔙 Main Menu'}]
+])
+
+ADDED_TO_CART_MARKUP = build_reply_markup(keyboard=[
+    [{'text': '🛒 View Cart'}, {'text': '📋 Continue Shopping'}],
+    [{'text': '🚚 Checkout'}, {'text': '🔙 Main Menu'}]
+])
+
+EMPTY_CART_MARKUP = build_reply_markup(keyboard=[
+    [{'text': '🛍️ Start Shopping'}, {'text': '🔙 Main Menu'}]
+])
+
+CART_MARKUP = build_reply_markup(keyboard=[
+    [{'text': '➕ Add More Items'}, {'text': '🗑️ Clear Cart'}],
+    [{'text': '🚚 Checkout Now'}, {'text': '📋 Continue Shopping'}],
+    [{'text': '🔙 Main Menu'}]
+])
+
+class TokenBucket:
+    """Blocking rate limiter allowing `rate` calls per second with bursts up to `capacity`"""
+    
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+# Stay under Telegram's limits of ~30 messages/s overall and ~1/s per chat,
+# letting a chat burst a few messages for multi-part replies
+_global_send_bucket = TokenBucket(rate=25, capacity=25)
+_chat_send_buckets = LRUDict(MAX_ACTIVE_USERS)
+_chat_send_buckets_lock = threading.Lock()
+
+def wait_for_send_slot(chat_id):
+    """Block until sending to chat_id fits within Telegram's rate limits"""
+    with _chat_send_buckets_lock:
+        bucket = _chat_send_buckets.get(chat_id)
+        if bucket is None:
+            bucket = _chat_send_buckets[chat_id] = TokenBucket(rate=1, capacity=3)
+    # Only take a global slot once this chat may send, so a throttled chat
+    # doesn't hold capacity other chats could use
+    bucket.acquire()
+    _global_send_bucket.acquire()
+
+# Sends run on the send pool, never on the update workers. Each chat's sends
+# wait in its own outbox and one pool task drains it in order, so a chat that
+# hits its rate limit only delays its own messages.
+_send_pool = ThreadPoolExecutor(max_workers=16, thread_name_prefix='send')
+_chat_outboxes = {}  # chat_id -> deque of pending sends; present while being drained
+_chat_outboxes_lock = threading.Lock()
+
+def queue_send(chat_id, send, *args):
+    """Queue send(*args) behind chat_id's earlier sends; returns a Future of its result"""
+    future = Future()
+    with _chat_outboxes_lock:
+        outbox = _chat_outboxes.get(chat_id)
+        start_drain = outbox is None
+        if start_drain:
+            outbox = _chat_outboxes[chat_id] = deque()
+        outbox.append((future, send, args))
+    if start_drain:
+        _send_pool.submit(drain_chat_outbox, chat_id)
+    return future
+
+def drain_chat_outbox(chat_id):
+    """Send everything queued for chat_id, pacing each send to the rate limits"""
+    while True:
+        with _chat_outboxes_lock:
+            outbox = _chat_outboxes[chat_id]
+            if not outbox:
+                del _chat_outboxes[chat_id]
+                return
+            future, send, args = outbox.popleft()
+        
+        try:
+            wait_for_send_slot(chat_id)
+            future.set_result(send(*args))
+        except Exception as e:
+            logger.exception("❌ Send to %s failed: %s", chat_id, e)
+            future.set_exception(e)
+
+def send_message(chat_id, text, keyboard=None, inline_keyboard=None, parse_mode=None, reply_markup_json=None):
+    """Queue a message for chat_id; returns a Future that resolves to whether Telegram accepted it"""
     if not TELEGRAM_TOKEN:
         logger.error("❌ Cannot send message: TELEGRAM_TOKEN not set")
-        return False
+        return None
         
     try:
-        url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
         payload = {
             'chat_id': chat_id, 
-            'text': text,
-            'parse_mode': parse_mode
+            'text': text
         }
+        
+        # Plain text unless the caller actually uses markup
+        if parse_mode:
+            payload['parse_mode'] = parse_mode
+
+        if reply_markup_json:
+            payload['reply_markup'] = reply_markup_json
+        elif keyboard or inline_keyboard:
+            payload['reply_markup'] = build_reply_markup(keyboard, inline_keyboard)
 
-        if keyboard:
-            payload['reply_markup'] = json.dumps({
-                'keyboard': keyboard,
-                'resize_keyboard': True,
-                'one_time_keyboard': False
-            })
-        elif inline_keyboard:
-            payload['reply_markup'] = json.dumps({
-                'inline_keyboard': inline_keyboard
-            })
-
-        response = requests.post(url, json=payload, timeout=10)
+        # Encode once with orjson; the flood-wait retry reuses the same body
+        return queue_send(chat_id, post_message, orjson.dumps(payload))
+        
+    except Exception as e:
+        logger.error("❌ Error sending message: %s", e)
+        return None
+
+def post_message(body):
+    """POST an encoded sendMessage body to Telegram, sitting out short flood waits"""
+    url = f"{TELEGRAM_API_URL}/sendMessage"
+    try:
+        response = telegram_session.post(url, data=body, headers=JSON_HEADERS, timeout=10)
+        
+        # Telegram flood control: wait as instructed and retry once
+        retry_after = get_flood_wait(response)
+        if retry_after is not None and retry_after <= MAX_FLOOD_WAIT:
+            logger.warning("⚠️ Rate limited by Telegram, retrying in %ss", retry_after)
+            time.sleep(retry_after)
+            response = telegram_session.post(url, data=body, headers=JSON_HEADERS, timeout=10)
         
         if response.status_code != 200:
-            logger.error(f"Telegram API error: {response.status_code} - {response.text}")
+            logger.error("Telegram API error: %s - %.200s", response.status_code, response.content)
             return False
             
         return True
         
     except Exception as e:
-        logger.error(f"❌ Error sending message: {e}")
+        logger.error("❌ Error sending message: %s", e)
         return False
 
 def send_document(chat_id, document_data, filename):
-    """Send document/file to user"""
+    """Queue a document for chat_id from bytes or an open binary file, which is closed once sent"""
     if not TELEGRAM_TOKEN:
-        return False
-        
+        return None
+    
+    caption = f'📊 {filename} - Generated on {datetime.now().strftime("%Y-%m-%d %H:%M")}'
+    return queue_send(chat_id, post_document, chat_id, document_data, filename, caption)
+
+def post_document(chat_id, document_data, filename, caption):
+    """Upload a document to Telegram, closing it afterwards if it's a file"""
     try:
-        url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendDocument"
+        url = f"{TELEGRAM_API_URL}/sendDocument"
         
         files = {
             'document': (filename, document_data, 'text/csv')
@@ -778,31 +1383,22 @@ def send_document(chat_id, document_data, filename):
         
         data = {
             'chat_id': chat_id,
-            'caption': f'📊 {filename} - Generated on {datetime.now().strftime("%Y-%m-%d %H:%M")}'
+            'caption': caption
         }
         
-        response = requests.post(url, files=files, data=data, timeout=30)
+        response = telegram_session.post(url, files=files, data=data, timeout=30)
         return response.status_code == 200
         
     except Exception as e:
-        logger.error(f"❌ Error sending document: {e}")
+        logger.error("❌ Error sending document: %s", e)
         return False
+    finally:
+        if hasattr(document_data, 'close'):
+            document_data.close()
 
 # ==================== ORDER SUMMARY ====================
-def create_enhanced_order_summary(customer_name, phone, address, cart, special_instructions=""):
-    """Create a beautifully formatted order summary"""
-    
-    subtotal = sum(details['price'] * details['quantity'] for details in cart.values())
-    delivery_fee = 0 if subtotal >= 50 else 5
-    total = subtotal + delivery_fee
-    
-    items_text = ""
-    for item_name, details in cart.items():
-        item_total = details['price'] * details['quantity']
-        items_text += f"• {item_name}\n"
-        items_text += f"  ${details['price']}/{details['unit']} × {details['quantity']} = ${item_total:.2f}\n"
-    
-    summary = f"""🛒 ORDER SUMMARY
+# Fixed summary layout, filled in with str.format per order
+ORDER_SUMMARY_TEMPLATE = """🛒 ORDER SUMMARY
 
 👤 Customer Details:
 Name: {customer_name}
@@ -814,35 +1410,80 @@ Address: {address}
 💵 Pricing:
 Subtotal: ${subtotal:.2f}
 Delivery Fee: ${delivery_fee:.2f}
-{'🎉 FREE DELIVERY (Order > $50)' if delivery_fee == 0 else f'🎯 Add ${50 - subtotal:.2f} more for FREE delivery!'}
+{delivery_note}
 💰 TOTAL: ${total:.2f}
 
-{f'📝 Special Instructions: {special_instructions}' if special_instructions else '📝 Special Instructions: None'}
+📝 Special Instructions: {special_instructions}
     
 ⏰ Expected Delivery: Within 2 hours
-🕐 Order Time: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}"""
+🕐 Order Time: {order_time}"""
+
+def _finalize_cart(cart):
+    """Walk the cart once, collecting the subtotal and summary item lines"""
+    subtotal = 0
+    summary_lines = []
+    for item_name, details in cart.items():
+        item_total = details['price'] * details['quantity']
+        subtotal += item_total
+        summary_lines.append(
+            f"• {item_name}\n"
+            f"  ${details['price']}/{details['unit']} × {details['quantity']} = ${item_total:.2f}\n"
+        )
     
-    return summary, total
+    return {
+        'subtotal': subtotal,
+        'items_text': "".join(summary_lines)
+    }
+
+def create_enhanced_order_summary(customer_name, phone, address, cart, special_instructions="", order_time=None,
+                                  cart_totals=None):
+    """Create a beautifully formatted order summary"""
+    if cart_totals is None:
+        cart_totals = _finalize_cart(cart)
+    
+    subtotal = cart_totals['subtotal']
+    delivery_fee = 0 if subtotal >= 50 else 5
+    total = subtotal + delivery_fee
+    items_text = cart_totals['items_text']
+    
+    if delivery_fee == 0:
+        delivery_note = '🎉 FREE DELIVERY (Order > $50)'
+    else:
+        delivery_note = f'🎯 Add ${50 - subtotal:.2f} more for FREE delivery!'
+    
+    summary = ORDER_SUMMARY_TEMPLATE.format(
+        customer_name=customer_name,
+        phone=phone,
+        address=address,
+        items_text=items_text,
+        subtotal=subtotal,
+        delivery_fee=delivery_fee,
+        delivery_note=delivery_note,
+        total=total,
+        special_instructions=special_instructions or 'None',
+        order_time=order_time or datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    )
+    
+    return summary, subtotal, delivery_fee, total
 
 # ==================== CASH ON DELIVERY PROCESSING ====================
 def process_cash_on_delivery(chat_id, customer_name, phone, address, cart, special_instructions):
     """Process cash on delivery order"""
     try:
-        order_summary, total = create_enhanced_order_summary(
-            customer_name, phone, address, cart, special_instructions
+        # One timestamp for the summary and the tracking entry
+        order_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        
+        cart_totals = _finalize_cart(cart)
+        order_summary, subtotal, delivery_fee, total = create_enhanced_order_summary(
+            customer_name, phone, address, cart, special_instructions, order_time, cart_totals
         )
         
         order_id = generate_order_id()
-        save_order_tracking(order_id, chat_id, customer_name, phone, address, cart, total, "Pending")
-        
-        csv_success = save_order_to_csv(
-            chat_id, customer_name, phone, address, cart, 
-            special_instructions, order_id
+        save_order_tracking(
+            order_id, chat_id, customer_name, phone, address, cart, total, "Pending", order_time,
+            subtotal, delivery_fee, special_instructions
         )
         
-        if not csv_success:
-            logger.warning("⚠️ Order saved locally but CSV save failed")
-        
         confirmation = f"""✅ Order Confirmed! 🎉
 
 Thank you {customer_name}!
@@ -857,24 +1498,24 @@ We'll notify you when your order ships! 🚚
 
 We're preparing your fresh groceries! 🥦"""
         
+        # Confirmation and admin notification go out in parallel
         send_message(chat_id, confirmation)
         
         try:
             order_data = order_tracking[order_id]
             send_admin_order_notification(order_id, order_data)
         except Exception as e:
-            logger.warning(f"⚠️ Admin notification failed: {e}")
+            logger.warning("⚠️ Admin notification failed: %s", e)
         
-        if chat_id in user_carts:
-            user_carts[chat_id] = {}
+        # The cart now belongs to the tracked order
+        user_carts.pop(chat_id, None)
         user_sessions[chat_id] = {'step': 'main_menu'}
         
-        logger.info(f"✅ COD order completed successfully for {customer_name}, Order ID: {order_id}")
+        logger.info("✅ COD order completed successfully for %s, Order ID: %s", customer_name, order_id)
         return True
             
     except Exception as e:
-        logger.error(f"❌ Critical error in COD order: {e}")
-        logger.error(traceback.format_exc())
+        logger.exception("❌ Critical error in COD order: %s", e)
         send_message(chat_id, "❌ Sorry, there was an error processing your order. Please try again.")
         return False
 
@@ -892,13 +1533,7 @@ def handle_start(chat_id):
 
 <b>What would you like to do?</b>"""
 
-    keyboard = [
-        [{'text': '🛍️ Shop Groceries'}, {'text': '🛒 My Cart'}],
-        [{'text': '📦 Track Order'}, {'text': '📞 Contact Store'}],
-        [{'text': 'ℹ️ Store Info'}, {'text': '👨‍💼 Admin Panel'}]
-    ]
-
-    send_message(chat_id, welcome, keyboard=keyboard)
+    send_message(chat_id, welcome, parse_mode='HTML', reply_markup_json=MAIN_MENU_MARKUP)
     user_sessions[chat_id] = {'step': 'main_menu'}
 
 def show_categories(chat_id):
@@ -906,23 +1541,14 @@ def show_categories(chat_id):
 
 Choose a category to start shopping:"""
 
-    keyboard = [
-        [{'text': '🥦 Fresh Produce'}, {'text': '🥩 Meat & Poultry'}],
-        [{'text': '🥛 Dairy & Eggs'}, {'text': '🔙 Main Menu'}]
-    ]
-
-    send_message(chat_id, categories, keyboard=keyboard)
-
-def show_category_items(chat_id, category):
-    if category not in grocery_categories:
-        send_message(chat_id, "Category not found. Please choose from the menu.")
-        return
+    send_message(chat_id, categories, reply_markup_json=CATEGORIES_MARKUP)
 
-    items_text = f"{category}\n\nSelect an item to add to cart:"
+def render_category_markup(category):
+    """Serialize the add-to-cart keyboard for one category"""
     items = grocery_categories[category]
     inline_keyboard = []
 
-    for item_name, details in items.items():
+    for item_name, details in list(items.items()):
         button_text = f"{item_name} - ${details['price']}/{details['unit']}"
         inline_keyboard.append([{
             'text': button_text,
@@ -934,19 +1560,24 @@ def show_category_items(chat_id, category):
         {'text': '🛒 View Cart', 'callback_data': 'view_cart'}
     ])
 
-    send_message(chat_id, items_text, inline_keyboard=inline_keyboard)
+    return build_reply_markup(inline_keyboard=inline_keyboard)
+
+def show_category_items(chat_id, category):
+    if category not in grocery_categories:
+        send_message(chat_id, "Category not found. Please choose from the menu.")
+        return
+
+    items_text = f"{category}\n\nSelect an item to add to cart:"
+    markup = cached_catalog_render(('category', category), lambda: render_category_markup(category))
+    send_message(chat_id, items_text, reply_markup_json=markup)
     user_sessions[chat_id] = {'step': 'browsing_category', 'current_category': category}
 
 def handle_add_to_cart(chat_id, item_name):
-    item_details = None
-    for category, items in grocery_categories.items():
-        if item_name in items:
-            item_details = items[item_name]
-            break
-
-    if not item_details:
+    entry = item_index.get(item_name)
+    if not entry:
         send_message(chat_id, "Item not found. Please select from the menu.")
         return
+    category, item_details = entry
 
     if chat_id not in user_carts:
         user_carts[chat_id] = {}
@@ -962,33 +1593,27 @@ def handle_add_to_cart(chat_id, item_name):
 
     response = f"✅ Added to Cart!\n\n{item_name}\n${item_details['price']}/{item_details['unit']}\n\nWhat would you like to do next?"
 
-    keyboard = [
-        [{'text': '🛒 View Cart'}, {'text': '📋 Continue Shopping'}],
-        [{'text': '🚚 Checkout'}, {'text': '🔙 Main Menu'}]
-    ]
-
-    send_message(chat_id, response, keyboard=keyboard)
+    send_message(chat_id, response, reply_markup_json=ADDED_TO_CART_MARKUP)
 
 def show_cart(chat_id):
     if chat_id not in user_carts or not user_carts[chat_id]:
         cart_text = "🛒 Your cart is empty!\n\nStart shopping to add some delicious groceries! 🥦"
-        keyboard = [
-            [{'text': '🛍️ Start Shopping'}, {'text': '🔙 Main Menu'}]
-        ]
-        send_message(chat_id, cart_text, keyboard=keyboard)
+        send_message(chat_id, cart_text, reply_markup_json=EMPTY_CART_MARKUP)
         return
 
     cart = user_carts[chat_id]
     total = 0
-    cart_text = "🛒 Your Shopping Cart\n\n"
+    parts = ["🛒 Your Shopping Cart\n\n"]
 
     for item_name, details in cart.items():
         item_total = details['price'] * details['quantity']
         total += item_total
-        cart_text += f"• {item_name}\n"
-        cart_text += f"  ${details['price']}/{details['unit']} × {details['quantity']} = ${item_total:.2f}\n\n"
+        parts.append(
+            f"• {item_name}\n"
+            f"  ${details['price']}/{details['unit']} × {details['quantity']} = ${item_total:.2f}\n\n"
+        )
 
-    cart_text += f"💵 Subtotal: ${total:.2f}"
+    cart_text = "".join(parts) + f"💵 Subtotal: ${total:.2f}"
     delivery_fee = 0 if total >= 50 else 5
     final_total = total + delivery_fee
 
@@ -1000,13 +1625,7 @@ def show_cart(chat_id):
     else:
         cart_text += f"\n\n✅ You qualify for FREE delivery!"
 
-    keyboard = [
-        [{'text': '➕ Add More Items'}, {'text': '🗑️ Clear Cart'}],
-        [{'text': '🚚 Checkout Now'}, {'text': '📋 Continue Shopping'}],
-        [{'text': '🔙 Main Menu'}]
-    ]
-
-    send_message(chat_id, cart_text, keyboard=keyboard)
+    send_message(chat_id, cart_text, reply_markup_json=CART_MARKUP)
 
 def handle_checkout(chat_id):
     if chat_id not in user_carts or not user_carts[chat_id]:
@@ -1017,416 +1636,599 @@ def handle_checkout(chat_id):
     send_message(chat_id, "🚚 Let's get your order delivered!\n\nPlease provide your full name:")
     user_sessions[chat_id] = {'step': 'awaiting_name'}
 
+def clear_cart(chat_id):
+    if chat_id in user_carts:
+        user_carts[chat_id] = {}
+    send_message(chat_id, "🛒 Your cart has been cleared!")
+    show_categories(chat_id)
+
+def show_user_orders(chat_id):
+    order_ids = orders_by_user.get(chat_id)
+    
+    if order_ids:
+        parts = ["📦 Your Orders:\n\n"]
+        for order_id in order_ids[-5:]:
+            order = order_tracking[order_id]
+            status_emoji = {
+                'Pending': '⏳',
+                'Shipped': '🚚', 
+                'Delivered': '✅',
+                'Cancelled': '❌'
+            }.get(order['status'], '📦')
+            
+            parts.append(
+                f"{status_emoji} Order #{order_id}\n"
+                f"Status: {order['status']}\n"
+                f"Total: ${order['total']:.2f}\n"
+                f"Date: {order['created_at']}\n\n"
+            )
+        send_message(chat_id, "".join(parts))
+    else:
+        send_message(chat_id, "📦 You don't have any orders yet. Start shopping! 🛍️")
+
+def show_contact_info(chat_id):
+    send_message(chat_id, "📞 FreshMart Contact Info:\n\n🏪 Store: FreshMart Grocery\n📞 Phone: 555-1234\n📍 Address: 123 Main Street\n⏰ Hours: 7 AM - 10 PM Daily")
+
+def show_store_info(chat_id):
+    store_info = f"""🏪 FreshMart Grocery
+
+🌟 Your trusted local grocery store!
+
+🚚 Free delivery on orders over $50
+💰 Cash on delivery only
+⏰ Fast 2-hour delivery
+🥦 Fresh produce daily
+📞 Call: 555-1234
+
+📊 All orders logged to CSV files
+📥 Admin can download data anytime"""
+    send_message(chat_id, store_info)
+
+# ==================== WEBHOOK SETUP ====================
+def set_webhook():
+    """Register WEBHOOK_URL with Telegram so updates are pushed to us"""
+    url = f"{TELEGRAM_API_URL}/setWebhook"
+    payload = {
+        'url': WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+        'max_connections': 40,
+        'allowed_updates': ['message', 'callback_query'],
+        'secret_token': WEBHOOK_SECRET
+    }
+    
+    try:
+        response = telegram_session.post(url, data=orjson.dumps(payload), headers=JSON_HEADERS, timeout=10)
+        if response.status_code == 200 and orjson.loads(response.content).get('ok'):
+            # The path carries the secret, so only log the base URL
+            logger.info("🔗 Webhook registered at %s", WEBHOOK_URL)
+            return True
+        logger.error("❌ setWebhook failed: %s - %.200s", response.status_code, response.text)
+    except Exception as e:
+        logger.error("❌ setWebhook error: %s", e)
+    return False
+
+def delete_webhook():
+    """Remove any registered webhook so getUpdates is allowed again"""
+    url = f"{TELEGRAM_API_URL}/deleteWebhook"
+    try:
+        telegram_session.post(url, timeout=10)
+    except Exception as e:
+        logger.warning("⚠️ deleteWebhook error: %s", e)
+
 # ==================== FIXED GET_UPDATES FUNCTION ====================
+# Polling backs off by pausing until a monotonic deadline instead of
+# sleeping inside get_updates; the wait doubles on consecutive errors
+POLL_CONFLICT_PAUSE = 30
+POLL_ERROR_BACKOFF = 5
+POLL_MAX_BACKOFF = 60
+_poll_paused_until = 0.0
+_poll_backoff = POLL_ERROR_BACKOFF
+
+def pause_polling(seconds):
+    """Skip getUpdates calls for the given number of seconds"""
+    global _poll_paused_until
+    _poll_paused_until = time.monotonic() + seconds
+
+def back_off_polling():
+    """Pause polling after an error, doubling the pause up to POLL_MAX_BACKOFF"""
+    global _poll_backoff
+    pause_polling(_poll_backoff)
+    _poll_backoff = min(_poll_backoff * 2, POLL_MAX_BACKOFF)
+
 def get_updates(offset=None):
     """Get updates from Telegram with proper error handling and connection recovery"""
-    global last_update_id
+    global _poll_backoff
     
-    if not TELEGRAM_TOKEN:
+    if not TELEGRAM_TOKEN or time.monotonic() < _poll_paused_until:
         return None
         
-    url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/getUpdates"
+    url = f"{TELEGRAM_API_URL}/getUpdates"
     params = {'timeout': 30, 'offset': offset or last_update_id + 1}
         
     try:
-        response = requests.post(url, params=params, timeout=35)
+        response = telegram_session.post(url, params=params, timeout=35)
         if response.status_code == 200:
-            data = response.json()
+            _poll_backoff = POLL_ERROR_BACKOFF
+            data = orjson.loads(response.content)
             if data.get('ok') and data.get('result'):
-                updates = data['result']
-                if updates:
-                    last_update_id = max(update['update_id'] for update in updates)
                 return data
             return None
         elif response.status_code == 409:
-            logger.error("❌ Another bot instance is running! This instance will pause for 30 seconds.")
+            logger.error("❌ Another bot instance is running! This instance will pause for %s seconds.", POLL_CONFLICT_PAUSE)
             logger.info("💡 Solution: Stop other instances or wait for Railway to stabilize")
-            time.sleep(30)  # Wait 30 seconds before retrying
+            pause_polling(POLL_CONFLICT_PAUSE)
             return None
         else:
-            logger.error(f"Telegram API error: {response.status_code}")
-            time.sleep(5)  # Shorter wait for other errors
+            logger.error("Telegram API error: %s", response.status_code)
+            back_off_polling()
             return None
     except Exception as e:
-        logger.error(f"get_updates error: {e}")
-        time.sleep(5)
+        logger.error("get_updates error: %s", e)
+        back_off_polling()
         return None
 
 # ==================== FIXED CALLBACK HANDLER ====================
 def handle_callback_query(chat_id, callback_data):
     try:
-        logger.info(f"🔘 Processing callback: {callback_data}")
+        logger.info("🔘 Processing callback: %s", callback_data)
         
-        if callback_data.startswith('add_'):
-            item_name = callback_data[4:]
-            handle_add_to_cart(chat_id, item_name)
-            
-        elif callback_data == 'back_categories':
-            show_categories(chat_id)
-            
-        elif callback_data == 'view_cart':
-            show_cart(chat_id)
-            
-        elif callback_data.startswith(('ship_', 'cancel_', 'deliver_', 'details_')):
-            handle_admin_callback(chat_id, callback_data)
-            
-        elif callback_data.startswith('update_price_'):
-            item_name = callback_data[13:]
-            handle_admin_price_update(chat_id, item_name)
-            
-        elif callback_data.startswith('newitem_cat_'):
-            category = callback_data[12:]
-            # Store the category in session with proper error handling
-            if chat_id not in user_sessions:
-                user_sessions[chat_id] = {}
-            user_sessions[chat_id].update({
-                'step': 'awaiting_new_item_name',
-                'new_item_category': category
-            })
-            send_message(chat_id, f"📋 Category: {category}\n\nPlease enter the new item name:")
-            
-        elif callback_data.startswith('remove_cat_'):
-            category = callback_data[11:]
-            show_remove_items_from_category(chat_id, category)
-            
-        elif callback_data.startswith('remove_item_'):
-            item_name = callback_data[12:]
-            remove_item_from_category(chat_id, item_name)
-            
-        elif callback_data == 'admin_back' or callback_data == 'admin_cancel':
-            show_admin_panel(chat_id)
+        action = CALLBACK_ACTIONS.get(callback_data)
+        handler, value = (None, None) if action else find_callback_handler(callback_data)
+        
+        # Gate on the handler the data resolved to, not on how the data is spelled
+        if (action or handler) in ADMIN_CALLBACK_HANDLERS and not is_admin(chat_id):
+            logger.warning("⚠️ Ignored admin callback from %s", chat_id)
+            return
+        
+        if action:
+            action(chat_id)
             
-        elif callback_data.startswith('download_'):
-            handle_download_request(chat_id, callback_data)
+        elif handler:
+            handler(chat_id, value)
             
         else:
-            logger.warning(f"❌ Unknown callback data: {callback_data}")
+            logger.warning("❌ Unknown callback data: %s", callback_data)
             send_message(chat_id, "❌ Unknown action. Please try again.")
             
     except Exception as e:
-        logger.error(f"❌ Callback query error: {e}")
-        logger.error(traceback.format_exc())
+        logger.exception("❌ Callback query error: %s", e)
         send_message(chat_id, "❌ Sorry, an error occurred. Please try again.")
 
-def handle_download_request(chat_id, callback_data):
-    """Handle CSV download requests"""
+def handle_download_request(chat_id, kind):
+    """Handle CSV download requests for 'orders', 'prices' or 'both'"""
     if not is_admin(chat_id):
         return
     
     try:
-        if callback_data == 'download_orders':
-            file_data = get_csv_file('orders')
-            if file_data:
-                send_document(chat_id, file_data, 'freshmart_orders.csv')
+        # Files are handed to requests as open handles rather than read up
+        # front; send_document closes each one after its upload
+        if kind == 'orders':
+            file = get_csv_file('orders')
+            if file:
+                send_document(chat_id, file, 'freshmart_orders.csv')
             else:
                 send_message(chat_id, "❌ Failed to generate orders CSV")
                 
-        elif callback_data == 'download_prices':
-            file_data = get_csv_file('prices')
-            if file_data:
-                send_document(chat_id, file_data, 'freshmart_prices.csv')
+        elif kind == 'prices':
+            file = get_csv_file('prices')
+            if file:
+                send_document(chat_id, file, 'freshmart_prices.csv')
             else:
                 send_message(chat_id, "❌ Failed to generate prices CSV")
                 
-        elif callback_data == 'download_both':
-            orders_data = get_csv_file('orders')
-            prices_data = get_csv_file('prices')
+        elif kind == 'both':
+            orders_file = get_csv_file('orders')
+            prices_file = get_csv_file('prices')
             
-            if orders_data:
-                send_document(chat_id, orders_data, 'freshmart_orders.csv')
-            if prices_data:
-                send_document(chat_id, prices_data, 'freshmart_prices.csv')
+            # Both uploads queue on the admin's outbox without holding up this worker
+            if orders_file:
+                send_document(chat_id, orders_file, 'freshmart_orders.csv')
+            if prices_file:
+                send_document(chat_id, prices_file, 'freshmart_prices.csv')
                 
-            if not orders_data and not prices_data:
+            if not orders_file and not prices_file:
                 send_message(chat_id, "❌ Failed to generate CSV files")
         
     except Exception as e:
-        logger.error(f"❌ Download error: {e}")
+        logger.error("❌ Download error: %s", e)
         send_message(chat_id, "❌ Error generating download files")
 
+def handle_new_item_category(chat_id, category):
+    """Remember the category picked for a new item and ask for its name"""
+    session = user_sessions.get(chat_id)
+    if session is None:
+        session = user_sessions[chat_id] = {}
+    session.update({
+        'step': 'awaiting_new_item_name',
+        'new_item_category': category
+    })
+    send_message(chat_id, f"📋 Category: {category}\n\nPlease enter the new item name:")
+
+# ==================== CALLBACK DISPATCH ====================
+# Callbacks without a value
+CALLBACK_ACTIONS = {
+    'back_categories': show_categories,
+    'view_cart': show_cart,
+    'admin_back': show_admin_panel,
+    'admin_cancel': show_admin_panel
+}
+
+# Callbacks shaped '<prefix>_<value>'; the handler receives the value
+CALLBACK_PREFIX_HANDLERS = {
+    **ORDER_ACTIONS,
+    'add': handle_add_to_cart,
+    'update_price': handle_admin_price_update,
+    'newitem_cat': handle_new_item_category,
+    'remove_cat': show_remove_items_from_category,
+    'remove_item': remove_item_from_category,
+    'download': handle_download_request
+}
+
+# Callback handlers that only the admin may trigger
+ADMIN_CALLBACK_HANDLERS = {
+    *ORDER_ACTIONS.values(),
+    show_admin_panel,
+    handle_admin_price_update,
+    handle_new_item_category,
+    show_remove_items_from_category,
+    remove_item_from_category,
+    handle_download_request
+}
+
+def find_callback_handler(callback_data):
+    """Split callback data into its prefix handler and non-empty value, or (None, None)"""
+    prefix, _, value = callback_data.partition('_')
+    handler = CALLBACK_PREFIX_HANDLERS.get(prefix)
+    if handler is None:
+        # Two-word prefixes such as 'update_price_<item>'
+        second, _, value = value.partition('_')
+        handler = CALLBACK_PREFIX_HANDLERS.get(f'{prefix}_{second}')
+    return (handler, value) if handler and value else (None, None)
+
 # ==================== FIXED MESSAGE HANDLER ====================
-def handle_message(chat_id, text):
+# Exact-text menu buttons and commands
+MESSAGE_HANDLERS = {
+    '/start': handle_start,
+    '🔙 Main Menu': handle_start,
+    '🛍️ Shop Groceries': show_categories,
+    '🛍️ Start Shopping': show_categories,
+    '📋 Continue Shopping': show_categories,
+    '➕ Add More Items': show_categories,
+    '🛒 My Cart': show_cart,
+    '🛒 View Cart': show_cart,
+    '🗑️ Clear Cart': clear_cart,
+    '🚚 Checkout': handle_checkout,
+    '🚚 Checkout Now': handle_checkout,
+    '📦 Track Order': show_user_orders,
+    '📞 Contact Store': show_contact_info,
+    'ℹ️ Store Info': show_store_info,
+    '/admin': show_admin_panel,
+    '👨‍💼 Admin Panel': show_admin_panel
+}
+
+# Admin panel buttons, only looked up for the admin chat
+ADMIN_MESSAGE_HANDLERS = {
+    '📊 View All Items': show_all_items_admin,
+    '💰 Update Price': show_items_for_price_update,
+    '🆕 Add New Item': handle_admin_new_item,
+    '🗑️ Remove Item': handle_admin_remove_item,
+    '📦 View Orders': show_all_orders_admin,
+    '📥 Download Data': show_download_panel,
+    '🔄 Refresh Menu': refresh_menu_admin
+}
+
+def handle_name_step(chat_id, text, session):
+    """Store the customer name and ask for a phone number"""
+    customer_name = text
+    user_sessions[chat_id] = {'step': 'awaiting_phone', 'customer_name': customer_name}
+    send_message(chat_id, f"👋 Thanks {customer_name}! Now please provide your phone number for delivery updates:")
+
+def handle_phone_step(chat_id, text, session):
+    """Store the phone number and ask for the delivery address"""
+    user_phone = text
+    customer_name = session['customer_name']
+    user_sessions[chat_id] = {'step': 'awaiting_address', 'customer_name': customer_name, 'phone': user_phone}
+    send_message(chat_id, "📦 Great! Now please provide your delivery address:")
+
+def handle_address_step(chat_id, text, session):
+    """Store the address and ask for delivery instructions"""
+    user_address = text
+    customer_name = session['customer_name']
+    user_phone = session['phone']
+    user_sessions[chat_id] = {'step': 'awaiting_instructions', 'customer_name': customer_name, 'phone': user_phone, 'address': user_address}
+    send_message(chat_id, "📝 Any special delivery instructions?\n\n(e.g., 'Leave at door', 'Call before delivery', or type 'None'):")
+
+def handle_instructions_step(chat_id, text, session):
+    """Place the cash-on-delivery order with the collected details"""
+    special_instructions = text if text.lower() != 'none' else ""
+    process_cash_on_delivery(
+        chat_id,
+        session['customer_name'],
+        session['phone'],
+        session['address'],
+        user_carts[chat_id],
+        special_instructions
+    )
+
+def handle_cancel_reason_step(chat_id, text, session):
+    """Cancel the order being handled with the admin's reason"""
+    if not is_admin(chat_id):
+        handle_start(chat_id)
+        return
+    order_id = session.get('order_id')
+    if order_id and update_order_status(order_id, 'Cancelled', text):
+        send_message(chat_id, f"✅ Order #{order_id} cancelled! Customer notified with your reason.")
+    else:
+        send_message(chat_id, f"❌ Failed to cancel order #{order_id}")
+    user_sessions[chat_id] = {'step': 'admin_panel'}
+
+def handle_new_price_step(chat_id, text, session):
+    """Apply the admin's new price to the item being edited"""
+    if not is_admin(chat_id):
+        handle_start(chat_id)
+        return
     try:
-        logger.info(f"📩 Processing message: {text}")
-        
-        if text == '/start':
-            handle_start(chat_id)
-            
-        elif text == '🛍️ Shop Groceries':
-            show_categories(chat_id)
-            
-        elif text == '🛒 My Cart':
-            show_cart(chat_id)
-            
-        elif text == '📦 Track Order':
-            user_orders = []
-            for order_id, order in order_tracking.items():
-                if order['chat_id'] == chat_id:
-                    user_orders.append((order_id, order))
-            
-            if user_orders:
-                track_text = "📦 Your Orders:\n\n"
-                for order_id, order in user_orders[-5:]:
-                    status_emoji = {
-                        'Pending': '⏳',
-                        'Shipped': '🚚', 
-                        'Delivered': '✅',
-                        'Cancelled': '❌'
-                    }.get(order['status'], '📦')
-                    
-                    track_text += f"{status_emoji} Order #{order_id}\n"
-                    track_text += f"Status: {order['status']}\n"
-                    track_text += f"Total: ${order['total']:.2f}\n"
-                    track_text += f"Date: {order['created_at']}\n\n"
-                send_message(chat_id, track_text)
-            else:
-                send_message(chat_id, "📦 You don't have any orders yet. Start shopping! 🛍️")
-                
-        elif text == '🔙 Main Menu':
-            handle_start(chat_id)
-            
-        elif text == '📋 Continue Shopping':
-            show_categories(chat_id)
-            
-        elif text == '➕ Add More Items':
-            show_categories(chat_id)
-            
-        elif text == '🗑️ Clear Cart':
-            if chat_id in user_carts:
-                user_carts[chat_id] = {}
-            send_message(chat_id, "🛒 Your cart has been cleared!")
-            show_categories(chat_id)
-            
-        elif text == '🚚 Checkout Now' or text == '🚚 Checkout':
-            handle_checkout(chat_id)
-            
-        elif text in grocery_categories:
-            show_category_items(chat_id, text)
-            
-        # ADMIN COMMANDS
-        elif text == '/admin' or text == '👨‍💼 Admin Panel':
+        new_price = float(text)
+        item_name = session['editing_item']
+        category = session['item_category']
+        grocery_categories[category][item_name]['price'] = new_price
+        catalog_changed()
+        schedule_prices_save()
+        send_message(chat_id, 
+            f"✅ Price updated!\n\n"
+            f"📦 {item_name}\n"
+            f"💰 New Price: ${new_price}/{grocery_categories[category][item_name]['unit']}"
+        )
+        show_admin_panel(chat_id)
+    except ValueError:
+        send_message(chat_id, "❌ Please enter a valid number (e.g., 12.99)")
+    except Exception as e:
+        logger.error("❌ Error updating price: %s", e)
+        send_message(chat_id, "❌ Error updating price. Please try again.")
+        show_admin_panel(chat_id)
+
+def handle_new_item_name_step(chat_id, text, session):
+    """Store the new item name and ask for its price"""
+    if not is_admin(chat_id):
+        handle_start(chat_id)
+        return
+    item_name = text
+    session.update({
+        'step': 'awaiting_new_item_price',
+        'new_item_name': item_name
+    })
+    send_message(chat_id, f"📦 Item Name: {item_name}\n\nPlease enter the price (e.g., 12.99):")
+
+def handle_new_item_price_step(chat_id, text, session):
+    """Store the new item price and ask for its unit"""
+    if not is_admin(chat_id):
+        handle_start(chat_id)
+        return
+    try:
+        item_price = float(text)
+        # Check if required session data exists
+        if 'new_item_name' not in session or 'new_item_category' not in session:
+            logger.error("❌ Missing session data: %s", session)
+            send_message(chat_id, "❌ Session expired. Please start over.")
             show_admin_panel(chat_id)
+            return
             
-        elif text == '📊 View All Items' and is_admin(chat_id):
-            show_all_items_admin(chat_id)
-            
-        elif text == '💰 Update Price' and is_admin(chat_id):
-            show_items_for_price_update(chat_id)
-            
-        elif text == '🆕 Add New Item' and is_admin(chat_id):
-            handle_admin_new_item(chat_id)
-            
-        elif text == '🗑️ Remove Item' and is_admin(chat_id):
-            handle_admin_remove_item(chat_id)
-            
-        elif text == '📦 View Orders' and is_admin(chat_id):
-            show_all_orders_admin(chat_id)
-            
-        elif text == '📥 Download Data' and is_admin(chat_id):
-            show_download_panel(chat_id)
-            
-        elif text == '🔄 Refresh Menu' and is_admin(chat_id):
-            load_prices_from_csv()
-            send_message(chat_id, "✅ Menu refreshed with latest prices!")
+        item_name = session['new_item_name']
+        category = session['new_item_category']
+        # Update session properly
+        session.update({
+            'step': 'awaiting_new_item_unit',
+            'new_item_name': item_name,
+            'new_item_price': item_price,
+            'new_item_category': category
+        })
+        send_message(chat_id, 
+            f"📦 Item: {item_name}\n"
+            f"💰 Price: ${item_price}\n\n"
+            f"Please enter the unit (e.g., kg, liter, pack, dozen):"
+        )
+    except ValueError:
+        send_message(chat_id, "❌ Please enter a valid price number")
+    except Exception as e:
+        logger.error("❌ Error setting price: %s", e)
+        logger.debug("Session data: %s", session)
+        send_message(chat_id, "❌ Error setting price. Please try again.")
+        show_admin_panel(chat_id)
+
+def handle_new_item_unit_step(chat_id, text, session):
+    """Add the new item to its category with the given unit"""
+    if not is_admin(chat_id):
+        handle_start(chat_id)
+        return
+    try:
+        unit = text
+        # Check if all required session data exists
+        required_fields = ['new_item_name', 'new_item_price', 'new_item_category']
+        if not all(field in session for field in required_fields):
+            logger.error("❌ Missing session data: %s", session)
+            send_message(chat_id, "❌ Session expired. Please start over.")
             show_admin_panel(chat_id)
+            return
             
-        # ORDER SESSION HANDLING
-        elif user_sessions.get(chat_id, {}).get('step') == 'awaiting_name':
-            customer_name = text
-            user_sessions[chat_id] = {'step': 'awaiting_phone', 'customer_name': customer_name}
-            send_message(chat_id, f"👋 Thanks {customer_name}! Now please provide your phone number for delivery updates:")
-            
-        elif user_sessions.get(chat_id, {}).get('step') == 'awaiting_phone':
-            user_phone = text
-            customer_name = user_sessions[chat_id]['customer_name']
-            user_sessions[chat_id] = {'step': 'awaiting_address', 'customer_name': customer_name, 'phone': user_phone}
-            send_message(chat_id, "📦 Great! Now please provide your delivery address:")
-            
-        elif user_sessions.get(chat_id, {}).get('step') == 'awaiting_address':
-            user_address = text
-            customer_name = user_sessions[chat_id]['customer_name']
-            user_phone = user_sessions[chat_id]['phone']
-            user_sessions[chat_id] = {'step': 'awaiting_instructions', 'customer_name': customer_name, 'phone': user_phone, 'address': user_address}
-            send_message(chat_id, "📝 Any special delivery instructions?\n\n(e.g., 'Leave at door', 'Call before delivery', or type 'None'):")
-            
-        elif user_sessions.get(chat_id, {}).get('step') == 'awaiting_instructions':
-            special_instructions = text if text.lower() != 'none' else ""
-            session_data = user_sessions[chat_id]
-            process_cash_on_delivery(
-                chat_id,
-                session_data['customer_name'],
-                session_data['phone'],
-                session_data['address'],
-                user_carts[chat_id],
-                special_instructions
-            )
-            
-        # ADMIN SESSION HANDLING
-        elif user_sessions.get(chat_id, {}).get('step') == 'awaiting_cancel_reason':
-            order_id = user_sessions[chat_id].get('order_id')
-            if order_id and update_order_status(order_id, 'Cancelled', text):
-                send_message(chat_id, f"✅ Order #{order_id} cancelled! Customer notified with your reason.")
-            else:
-                send_message(chat_id, f"❌ Failed to cancel order #{order_id}")
-            user_sessions[chat_id] = {'step': 'admin_panel'}
-            
-        elif user_sessions.get(chat_id, {}).get('step') == 'awaiting_new_price':
-            try:
-                new_price = float(text)
-                session_data = user_sessions[chat_id]
-                item_name = session_data['editing_item']
-                category = session_data['item_category']
-                grocery_categories[category][item_name]['price'] = new_price
-                save_prices_to_csv()
-                send_message(chat_id, 
-                    f"✅ Price updated!\n\n"
-                    f"📦 {item_name}\n"
-                    f"💰 New Price: ${new_price}/{grocery_categories[category][item_name]['unit']}"
-                )
-                show_admin_panel(chat_id)
-            except ValueError:
-                send_message(chat_id, "❌ Please enter a valid number (e.g., 12.99)")
-            except Exception as e:
-                logger.error(f"❌ Error updating price: {e}")
-                send_message(chat_id, "❌ Error updating price. Please try again.")
-                show_admin_panel(chat_id)
-                
-        # FIXED: Add New Item session handling with proper session management
-        elif user_sessions.get(chat_id, {}).get('step') == 'awaiting_new_item_name':
-            item_name = text
-            # Ensure session exists and update it properly
-            if chat_id not in user_sessions:
-                user_sessions[chat_id] = {}
-            user_sessions[chat_id].update({
-                'step': 'awaiting_new_item_price',
-                'new_item_name': item_name
-            })
-            send_message(chat_id, f"📦 Item Name: {item_name}\n\nPlease enter the price (e.g., 12.99):")
-            
-        elif user_sessions.get(chat_id, {}).get('step') == 'awaiting_new_item_price':
-            try:
-                item_price = float(text)
-                session_data = user_sessions[chat_id]
-                # Check if required session data exists
-                if 'new_item_name' not in session_data or 'new_item_category' not in session_data:
-                    logger.error(f"❌ Missing session data: {session_data}")
-                    send_message(chat_id, "❌ Session expired. Please start over.")
-                    show_admin_panel(chat_id)
-                    return
-                    
-                item_name = session_data['new_item_name']
-                category = session_data['new_item_category']
-                # Update session properly
-                user_sessions[chat_id].update({
-                    'step': 'awaiting_new_item_unit',
-                    'new_item_name': item_name,
-                    'new_item_price': item_price,
-                    'new_item_category': category
-                })
-                send_message(chat_id, 
-                    f"📦 Item: {item_name}\n"
-                    f"💰 Price: ${item_price}\n\n"
-                    f"Please enter the unit (e.g., kg, liter, pack, dozen):"
-                )
-            except ValueError:
-                send_message(chat_id, "❌ Please enter a valid price number")
-            except Exception as e:
-                logger.error(f"❌ Error setting price: {e}")
-                logger.error(f"❌ Session data: {user_sessions.get(chat_id, {})}")
-                send_message(chat_id, "❌ Error setting price. Please try again.")
-                show_admin_panel(chat_id)
-                
-        elif user_sessions.get(chat_id, {}).get('step') == 'awaiting_new_item_unit':
-            try:
-                unit = text
-                session_data = user_sessions[chat_id]
-                # Check if all required session data exists
-                required_fields = ['new_item_name', 'new_item_price', 'new_item_category']
-                if not all(field in session_data for field in required_fields):
-                    logger.error(f"❌ Missing session data: {session_data}")
-                    send_message(chat_id, "❌ Session expired. Please start over.")
-                    show_admin_panel(chat_id)
-                    return
-                    
-                item_name = session_data['new_item_name']
-                item_price = session_data['new_item_price']
-                category = session_data['new_item_category']
-                
-                # Add the new item to the category
-                if category not in grocery_categories:
-                    grocery_categories[category] = {}
-                
-                grocery_categories[category][item_name] = {
-                    'price': item_price,
-                    'unit': unit
-                }
-                
-                # Save to CSV
-                save_prices_to_csv()
-                
-                send_message(chat_id,
-                    f"✅ New Item Added!\n\n"
-                    f"📦 {item_name}\n"
-                    f"💰 ${item_price}/{unit}\n"
-                    f"📋 Category: {category}"
-                )
-                show_admin_panel(chat_id)
-            except Exception as e:
-                logger.error(f"❌ Error adding new item: {e}")
-                logger.error(traceback.format_exc())
-                logger.error(f"❌ Session data: {user_sessions.get(chat_id, {})}")
-                send_message(chat_id, "❌ Error adding new item. Please try again.")
-                show_admin_panel(chat_id)
-                
-        elif text == '📞 Contact Store':
-            send_message(chat_id, "📞 FreshMart Contact Info:\n\n🏪 Store: FreshMart Grocery\n📞 Phone: 555-1234\n📍 Address: 123 Main Street\n⏰ Hours: 7 AM - 10 PM Daily")
-            
-        elif text == 'ℹ️ Store Info':
-            store_info = f"""🏪 FreshMart Grocery
-
-🌟 Your trusted local grocery store!
+        item_name = session['new_item_name']
+        item_price = session['new_item_price']
+        category = session['new_item_category']
+        
+        # Add the new item to the category
+        if category not in grocery_categories:
+            grocery_categories[category] = {}
+        
+        grocery_categories[category][item_name] = {
+            'price': item_price,
+            'unit': unit
+        }
+        item_index[item_name] = (category, grocery_categories[category][item_name])
+        catalog_changed()
+        
+        # Save to CSV
+        schedule_prices_save()
+        
+        send_message(chat_id,
+            f"✅ New Item Added!\n\n"
+            f"📦 {item_name}\n"
+            f"💰 ${item_price}/{unit}\n"
+            f"📋 Category: {category}"
+        )
+        show_admin_panel(chat_id)
+    except Exception as e:
+        logger.exception("❌ Error adding new item: %s", e)
+        logger.debug("Session data: %s", session)
+        send_message(chat_id, "❌ Error adding new item. Please try again.")
+        show_admin_panel(chat_id)
 
-🚚 Free delivery on orders over $50
-💰 Cash on delivery only
-⏰ Fast 2-hour delivery
-🥦 Fresh produce daily
-📞 Call: 555-1234
+# Free-text replies, keyed by the conversation step the chat is in. The admin
+# steps check is_admin themselves and send anyone else back to the start menu.
+SESSION_HANDLERS = {
+    'awaiting_name': handle_name_step,
+    'awaiting_phone': handle_phone_step,
+    'awaiting_address': handle_address_step,
+    'awaiting_instructions': handle_instructions_step,
+    'awaiting_cancel_reason': handle_cancel_reason_step,
+    'awaiting_new_price': handle_new_price_step,
+    'awaiting_new_item_name': handle_new_item_name_step,
+    'awaiting_new_item_price': handle_new_item_price_step,
+    'awaiting_new_item_unit': handle_new_item_unit_step
+}
 
-📊 All orders logged to CSV files
-📥 Admin can download data anytime"""
-            send_message(chat_id, store_info)
+def handle_message(chat_id, text):
+    try:
+        logger.info("📩 Processing message: %s", text)
+        
+        handler = MESSAGE_HANDLERS.get(text)
+        if not handler and is_admin(chat_id):
+            handler = ADMIN_MESSAGE_HANDLERS.get(text)
+        
+        if handler:
+            handler(chat_id)
+            
+        elif text in grocery_categories:
+            show_category_items(chat_id, text)
             
         else:
-            handle_start(chat_id)
+            session = user_sessions.get(chat_id)
+            session_handler = SESSION_HANDLERS.get(session.get('step')) if session else None
+            if session_handler:
+                session_handler(chat_id, text, session)
+            else:
+                handle_start(chat_id)
 
     except Exception as e:
-        logger.error(f"❌ Error handling message: {e}")
-        logger.error(traceback.format_exc())
+        logger.exception("❌ Error handling message: %s", e)
         send_message(chat_id, "❌ Sorry, an error occurred. Please try again.")
         handle_start(chat_id)
 
+# ==================== UPDATE DISPATCH ====================
+def dispatch_update(update):
+    """Route a single Telegram update to the message or callback handler"""
+    if 'message' in update and 'text' in update['message']:
+        chat_id = update['message']['chat']['id']
+        text = update['message']['text']
+        logger.info("📩 Message from %s: %s", chat_id, text)
+        restore_user_state(chat_id)
+        try:
+            handle_message(chat_id, text)
+        finally:
+            save_user_state(chat_id)
+
+    elif 'callback_query' in update:
+        callback = update['callback_query']
+        chat_id = callback['message']['chat']['id']
+        callback_data = callback['data']
+        logger.info("🔘 Callback from %s: %s", chat_id, callback_data)
+        restore_user_state(chat_id)
+        try:
+            handle_callback_query(chat_id, callback_data)
+        finally:
+            save_user_state(chat_id)
+
+def get_update_chat_id(update):
+    """Return the chat an update belongs to, or 0 if it has none we handle"""
+    if 'message' in update:
+        return update['message']['chat']['id']
+    if 'callback_query' in update:
+        return update['callback_query']['message']['chat']['id']
+    return 0
+
+# Updates are handled on worker threads so one slow chat doesn't hold up the
+# rest. Each chat always maps to the same worker, which keeps its updates in
+# the order Telegram delivered them.
+UPDATE_WORKERS = 8
+_update_queues = [queue.Queue() for _ in range(UPDATE_WORKERS)]
+
+def enqueue_update(update):
+    """Hand an update to the worker that owns its chat"""
+    try:
+        chat_id = get_update_chat_id(update)
+    except (KeyError, TypeError):
+        chat_id = 0
+    _update_queues[chat_id % UPDATE_WORKERS].put(update)
+
+def update_worker(update_queue):
+    """Process updates from one worker queue, logging any failure"""
+    while True:
+        update = update_queue.get()
+        try:
+            dispatch_update(update)
+        except Exception as e:
+            logger.exception("❌ Update processing error: %s", e)
+
+def start_update_workers():
+    """Start one daemon thread per update queue"""
+    for number, update_queue in enumerate(_update_queues):
+        threading.Thread(
+            target=update_worker, args=(update_queue,), name=f'update-{number}', daemon=True
+        ).start()
+
 # ==================== MAIN FUNCTION ====================
+def handle_shutdown(signum, frame):
+    """Write pending price changes before Railway stops the container or on Ctrl+C"""
+    logger.info("🛑 Shutting down, saving pending price changes...")
+    flush_prices_save()
+    raise SystemExit(0)
+
 def main():
+    global last_update_id
+
     if not TELEGRAM_TOKEN:
         logger.error("❌ CRITICAL: TELEGRAM_TOKEN environment variable not set!")
         exit(1)
 
-    # Start health check server in a separate thread
-    try:
-        health_thread = threading.Thread(target=start_health_check_server, daemon=True)
-        health_thread.start()
-        logger.info(f"🩺 Health check server started on port {PORT}")
-    except Exception as e:
-        logger.warning(f"⚠️ Health check server failed: {e}")
+    start_update_workers()
+    threading.Thread(target=prices_save_worker, name='prices-save', daemon=True).start()
+    signal.signal(signal.SIGTERM, handle_shutdown)
+    signal.signal(signal.SIGINT, handle_shutdown)
+
+    # Bind the health check server up front so webhook mode knows it can receive updates
+    health_thread = start_health_check_server()
 
     logger.info("🚀 FreshMart Grocery Bot Started on Railway!")
     logger.info("📊 Features: Order Tracking, Admin Controls, Real-time Updates")
     logger.info("💰 Payment: Cash on Delivery Only")
-    logger.info("💾 Data Storage: CSV Files")
+    logger.info("💾 Data Storage: SQLite with CSV export")
     logger.info("📥 Admin Features: Price Management, Inventory Control, Data Download")
     logger.info("🔄 Error Recovery: Auto-handles Telegram API conflicts")
     logger.info("📱 Ready to take orders!")
 
+    # In webhook mode the health server receives updates; just keep it alive
+    if WEBHOOK_URL and not health_thread:
+        logger.warning("⚠️ No HTTP server to receive webhooks, falling back to polling")
+    elif WEBHOOK_URL and set_webhook():
+        logger.info("📡 Running in webhook mode")
+        health_thread.join()
+        # serve_forever only returns if the server died; don't leave Telegram
+        # pushing to a dead endpoint, and let Railway restart us
+        logger.error("❌ Webhook server stopped, exiting")
+        delete_webhook()
+        exit(1)
+
+    # Fall back to long polling, which Telegram refuses while a webhook is set
+    delete_webhook()
+    logger.info("📡 Running in polling mode")
+
     # Main loop with error recovery
     error_count = 0
     max_errors = 10
@@ -1437,18 +2239,10 @@ def main():
 
             if updates and 'result' in updates:
                 for update in updates['result']:
-                    if 'message' in update and 'text' in update['message']:
-                        chat_id = update['message']['chat']['id']
-                        text = update['message']['text']
-                        logger.info(f"📩 Message from {chat_id}: {text}")
-                        handle_message(chat_id, text)
-
-                    elif 'callback_query' in update:
-                        callback = update['callback_query']
-                        chat_id = callback['message']['chat']['id']
-                        callback_data = callback['data']
-                        logger.info(f"🔘 Callback from {chat_id}: {callback_data}")
-                        handle_callback_query(chat_id, callback_data)
+                    update_id = update['update_id']
+                    if update_id > last_update_id:
+                        last_update_id = update_id
+                    enqueue_update(update)
                 
                 error_count = 0  # Reset error count on successful update
             else:
@@ -1456,8 +2250,7 @@ def main():
                 
         except Exception as e:
             error_count += 1
-            logger.error(f"❌ Main loop error #{error_count}: {e}")
-            logger.error(traceback.format_exc())
+            logger.exception("❌ Main loop error #%s: %s", error_count, e)
             
             if error_count > max_errors:
                 logger.error("🔄 Too many consecutive errors, waiting 60 seconds before continuing...")